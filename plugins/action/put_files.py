@@ -0,0 +1,63 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ansible.errors import AnsibleActionFail, AnsibleError
+from ansible.module_utils.common.text.converters import to_text
+from ansible.plugins.action import ActionBase
+
+
+class ActionModule(ActionBase):
+    """Copy many files into a container with a single command.
+
+    The files are handed to the put_files method of the openstack.osa.ssh
+    connection plugin, which packs them into one archive.
+    """
+
+    TRANSFERS_FILES = True
+    _VALID_ARGS = frozenset(('files',))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        files = self._task.args.get('files')
+        if not isinstance(files, list) or not files:
+            raise AnsibleActionFail('files must be a non-empty list')
+
+        if not getattr(self._connection, 'is_container', False) or \
+                not hasattr(self._connection, 'put_files'):
+            raise AnsibleActionFail(
+                'put_files needs a container target reached with the'
+                ' openstack.osa.ssh connection plugin'
+            )
+
+        entries = []
+        for item in files:
+            if not isinstance(item, dict) or \
+                    not item.get('src') or not item.get('dest'):
+                raise AnsibleActionFail(
+                    'every item of files needs a src and a dest, got %s'
+                    % item
+                )
+            try:
+                src = self._find_needle('files', item['src'])
+            except AnsibleError as e:
+                raise AnsibleActionFail(to_text(e))
+            entries.append(
+                (src, item['dest'], item.get('owner'), item.get('mode'))
+            )
+
+        result['dest'] = [dest for _, dest, _, _ in entries]
+        result['changed'] = True
+        if not self._task.check_mode:
+            self._connection.put_files(entries)
+        return result
@@ -0,0 +1,232 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+DOCUMENTATION = '''
+    callback: connection_timing
+    type: aggregate
+    short_description: Summarise openstack.osa.ssh connection timings
+    description:
+        - Reads the timing spans written by the openstack.osa.ssh connection
+          plugin to its C(timing_log) and prints the p50 and p95 latency of
+          every connection phase, and of every phase on each physical host,
+          at the end of each play.
+        - Phases timed within another phase, eg the PID lookup of a path
+          padding, are reported as C(<phase> in <parent>). Their time is
+          already part of the parent, so only phases that are not nested
+          count towards the total time of a physical host.
+    requirements:
+      - enable in configuration
+      - the ANSIBLE_OSA_CONNECTION_TIMING_LOG environment variable, which is
+        shared with the openstack.osa.ssh connection plugin
+    options:
+      timing_log:
+          description: Path of the JSON lines file written by the connection
+                       plugin.
+          env:
+               - name: ANSIBLE_OSA_CONNECTION_TIMING_LOG
+          ini:
+               - section: callback_connection_timing
+                 key: timing_log
+      host_limit:
+          description: Number of physical hosts to list, slowest total first.
+          default: 10
+          type: int
+          env:
+               - name: ANSIBLE_OSA_CONNECTION_TIMING_HOST_LIMIT
+          ini:
+               - section: callback_connection_timing
+                 key: host_limit
+      report_file:
+          description:
+            - Path of a JSON lines file to which the summary of every play is
+              appended as one machine readable document.
+          env:
+               - name: ANSIBLE_OSA_CONNECTION_TIMING_REPORT
+          ini:
+               - section: callback_connection_timing
+                 key: report_file
+'''
+
+import collections
+import json
+import os
+
+from ansible.plugins.callback import CallbackBase
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class CallbackModule(CallbackBase):
+    """Print a latency report for the container aware connection plugin."""
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'openstack.osa.connection_timing'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.play_name = None
+        self.offset = 0
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys,
+                                                var_options=var_options,
+                                                direct=direct)
+        self.timing_log = self.get_option('timing_log')
+        if self.timing_log:
+            self.timing_log = os.path.expanduser(self.timing_log)
+
+    def _log_size(self):
+        try:
+            return os.path.getsize(self.timing_log)
+        except (OSError, TypeError):
+            return 0
+
+    def _read_spans(self):
+        """Return the spans written since the current play started."""
+        spans = []
+        try:
+            with open(self.timing_log) as f:
+                f.seek(self.offset)
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except (IOError, OSError):
+            pass
+        return spans
+
+    def _report(self, title, groups):
+        self._display.display(
+            u'%-40s %8s %9s %9s %10s' % (title, 'count', 'p50', 'p95',
+                                         'total')
+        )
+        for name, durations in groups:
+            self._display.display(
+                u'%-40s %8d %8.3fs %8.3fs %9.1fs' % (
+                    name,
+                    len(durations),
+                    percentile(durations, 50),
+                    percentile(durations, 95),
+                    sum(durations)
+                )
+            )
+
+    @staticmethod
+    def _statistics(groups):
+        stats = {}
+        for name, durations in groups.items():
+            stats[name] = {
+                'count': len(durations),
+                'p50': percentile(durations, 50),
+                'p95': percentile(durations, 95),
+                'total': sum(durations)
+            }
+        return stats
+
+    def _write_report(self, phases, hosts, spans):
+        report_file = self.get_option('report_file')
+        if not report_file:
+            return
+        phase_stats = self._statistics(phases)
+        nested = set(self._phase_name(span) for span in spans
+                     if span.get('parent'))
+        for span in spans:
+            if span.get('bytes_written'):
+                phase = phase_stats[self._phase_name(span)]
+                phase['bytes'] = phase.get('bytes', 0) + span['bytes_written']
+        for name, phase in phase_stats.items():
+            phase['nested'] = name in nested
+            if phase.get('bytes') and phase['total']:
+                phase['bytes_per_second'] = phase['bytes'] / phase['total']
+        physical_hosts = {}
+        for host, host_phases in hosts.items():
+            stats = self._statistics(host_phases)
+            physical_hosts[host] = {
+                'phases': stats,
+                'total': sum(stats[name]['total'] for name in stats
+                             if name not in nested)
+            }
+        report = {
+            'play': self.play_name,
+            'time': spans[0].get('time'),
+            'phases': phase_stats,
+            'physical_hosts': physical_hosts
+        }
+        try:
+            with open(os.path.expanduser(report_file), 'a') as f:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+        except (IOError, OSError) as e:
+            self._display.warning(u'Unable to write the connection timing'
+                                  u' report: %s' % e)
+
+    @staticmethod
+    def _phase_name(span):
+        name = span.get('phase')
+        if span.get('detail'):
+            name = '%s (%s)' % (name, span['detail'])
+        if span.get('parent'):
+            name = '%s in %s' % (name, span['parent'])
+        return name
+
+    def _summarise(self):
+        if not self.timing_log or self.play_name is None:
+            return
+        spans = self._read_spans()
+        if not spans:
+            return
+
+        # Durations per phase, and per phase of every physical host. Nested
+        # spans are kept apart from their parents by their phase name, and
+        # are left out of the host totals used to rank the hosts.
+        phases = collections.defaultdict(list)
+        hosts = collections.defaultdict(lambda: collections.defaultdict(list))
+        totals = collections.defaultdict(float)
+        for span in spans:
+            name = self._phase_name(span)
+            duration = span.get('duration', 0.0)
+            phases[name].append(duration)
+            hosts[span.get('physical_host')][name].append(duration)
+            if not span.get('parent'):
+                totals[span.get('physical_host')] += duration
+
+        for durations in phases.values():
+            durations.sort()
+        for host_phases in hosts.values():
+            for durations in host_phases.values():
+                durations.sort()
+        self._write_report(phases, hosts, spans)
+
+        self._display.banner(u'CONNECTION TIMING [%s]' % self.play_name)
+        self._report('phase', sorted(phases.items()))
+        slowest = sorted(hosts, key=lambda host: totals[host], reverse=True)
+        for host in slowest[:self.get_option('host_limit')]:
+            self._display.display(u'')
+            self._report(u'%s (%.1fs)' % (host, totals[host]),
+                         sorted(hosts[host].items()))
+
+    def v2_playbook_on_play_start(self, play):
+        self._summarise()
+        self.play_name = play.get_name().strip()
+        self.offset = self._log_size()
+
+    def v2_playbook_on_stats(self, stats):
+        self._summarise()
+        self.play_name = None
@@ -47,15 +47,391 @@ DOCUMENTATION = '''
           description: Address of host running a given container
           vars:
                - name: physical_host_addr
+      container_pid_cache:
+          description:
+            - Directory on the deployment host used to share container PIDs
+              between tasks and forks. Set to an empty string to disable the
+              cache and look up the PID once per task.
+          default: ~/.ansible/osa_container_pids
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_PID_CACHE
+          vars:
+               - name: container_pid_cache
+      container_pid_cache_timeout:
+          description:
+            - Number of seconds a cached container PID is trusted before it
+              is looked up again.
+            - Commands run with the C(nsenter) exec method and streamed
+              fetches check a cached PID against the start time of the
+              process as part of the command itself. Other file transfers
+              trust a cached PID and look it up again when the transfer
+              fails, so after a container restart a transfer may reach a
+              recycled PID until the entry expires. Lower the timeout where
+              containers are restarted while a play runs.
+          default: 900
+          type: int
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_PID_CACHE_TIMEOUT
+          vars:
+               - name: container_pid_cache_timeout
+      container_pid_batch:
+          description:
+            - Look up the PID of every running container on a physical host
+              with a single command the first time any of them is targeted,
+              and store the results in the container PID cache for sibling
+              connections. Has no effect when the cache is disabled.
+          default: false
+          type: bool
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_PID_BATCH
+          vars:
+               - name: container_pid_batch
+      container_exec_method:
+          description:
+            - How commands are run inside a container. C(lxc-attach) attaches
+              to the container by name and runs the command through a login
+              shell. C(nsenter) enters the namespaces of the container init
+              process directly, using the PID from the container PID lookup,
+              and skips the login shell when C(container_user) is root. The
+              C(nsenter) method does not apply the container's LSM profile or
+              capability bounding set, so it is only suited to privileged
+              containers.
+          default: lxc-attach
+          choices:
+            - lxc-attach
+            - nsenter
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_EXEC_METHOD
+          vars:
+               - name: container_exec_method
+      container_shared_control_master:
+          description:
+            - Open the SSH ControlMaster to a physical host once, under a lock
+              on the deployment host, before connecting to any of its
+              containers. All containers on a physical host are reached
+              through the same address and user and so share one ControlPath.
+              Without the lock, forks for sibling containers race to create
+              the master and open their own connections when they lose.
+          default: true
+          type: bool
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_SHARED_CONTROL_MASTER
+          vars:
+               - name: container_shared_control_master
+      timing_log:
+          description:
+            - Path of a JSON lines file on the deployment host to which a
+              timing span is appended for every phase of a connection (PID
+              lookup, path padding, put, fetch, chown and exec). The
+              C(openstack.osa.connection_timing) callback plugin summarises
+              this file at the end of every play. Disabled when empty.
+          env:
+               - name: ANSIBLE_OSA_CONNECTION_TIMING_LOG
+          vars:
+               - name: osa_connection_timing_log
+      container_fetch_method:
+          description:
+            - How files are fetched from a container. C(transfer) uses the
+              regular ssh transfer method. C(stream) pipes the file over a
+              plain ssh session straight into the destination file, without
+              holding it in memory, and supports compression and resume.
+              Password authentication always uses C(transfer).
+          default: transfer
+          choices:
+            - transfer
+            - stream
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_FETCH_METHOD
+          vars:
+               - name: container_fetch_method
+      container_fetch_compression:
+          description:
+            - Compression applied on the physical host to streamed fetches.
+          default: none
+          choices:
+            - none
+            - gzip
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_FETCH_COMPRESSION
+          vars:
+               - name: container_fetch_compression
+      container_fetch_resume:
+          description:
+            - Resume a streamed fetch from the size of an existing
+              destination file instead of starting over. Partial files are
+              kept when a streamed fetch fails.
+            - The existing file is only resumed when it matches the start of
+              the remote file, otherwise the whole file is fetched again.
+          default: false
+          type: bool
+          env:
+               - name: ANSIBLE_OSA_CONTAINER_FETCH_RESUME
+          vars:
+               - name: container_fetch_resume
 '''
 
+import contextlib
+import fcntl
+import hashlib
 import importlib
+import json
 import os
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
 
+from ansible.errors import AnsibleError
 from ansible.module_utils.six.moves import shlex_quote
+from ansible.utils.path import makedirs_safe, unfrackpath
 
 SSH = importlib.import_module('ansible.plugins.connection.ssh')
 
+# Print the container pid followed by the start time of that pid (field 22 of
+# /proc/<pid>/stat). The start time allows a cached pid to be told apart from
+# a recycled one. The comm field may contain spaces so everything up to the
+# closing parenthesis is stripped before the fields are counted.
+PID_LOOKUP_COMMAND = (
+    u"pid=$(lxc-info -Hpn '%s') && [ -n \"$pid\" ] && "
+    u"printf '%%s %%s\\n' \"$pid\" "
+    u"\"$(sed 's/.*) //' /proc/$pid/stat | cut -d' ' -f20)\""
+)
+
+# Same as PID_LOOKUP_COMMAND, for every running container on the physical
+# host, prefixed with the container name.
+PID_BATCH_LOOKUP_COMMAND = (
+    u"for name in $(lxc-ls -1 --running); do "
+    u"pid=$(lxc-info -Hpn \"$name\") && [ -n \"$pid\" ] && "
+    u"printf '%s %s %s\\n' \"$name\" \"$pid\" "
+    u"\"$(sed 's/.*) //' /proc/$pid/stat | cut -d' ' -f20)\"; "
+    u"done; true"
+)
+
+# Printed by the nsenter exec path when the pid no longer belongs to the
+# container it was cached for.
+STALE_PID_MARKER = 'osa-stale-container-pid'
+
+# Namespaces entered, and environment set, by the nsenter exec path. The
+# environment mirrors what lxc-attach --clear-env provides.
+NSENTER_NAMESPACES = '--mount --uts --ipc --net --pid'
+NSENTER_ENVIRONMENT = (
+    'PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin '
+    'HOME=/root USER=root LOGNAME=root SHELL=/bin/sh'
+)
+
+# Printed by a streamed fetch when reading the remote file failed part way,
+# since the exit status of tail is lost in the pipe to gzip.
+STREAM_FAILED_MARKER = 'osa-stream-fetch-failed'
+
+# Largest file, in bytes, which put_file streams through a single command
+# when it also has to change the owner of the file. Larger files are sent
+# with the regular transfer method followed by a separate chown.
+PUT_FUSED_MAX_SIZE = 8 * 1024 * 1024
+
+
+def lock_file(path):
+    """Return path opened and exclusively locked.
+
+    The holder removes the file again with unlock_file, so a process which
+    was waiting on a removed file retries with the one now at path.
+    """
+    while True:
+        lock = open(path, 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def unlock_file(lock):
+    """Remove and release a file locked with lock_file."""
+    try:
+        os.unlink(lock.name)
+    except OSError:
+        pass
+    lock.close()
+
+
+class ContainerPidCache(object):
+    """File backed cache of container pids.
+
+    Ansible runs every task in a fresh fork, so the pid of a container can not
+    be kept in memory beyond the life of a single task. The cache keeps one
+    JSON file per physical host, keyed by container name, which all forks
+    share. Writes are serialised with a lock file, removed again once the
+    write is done, and files are replaced atomically so readers never see a
+    partial document.
+    """
+
+    def __init__(self, path, timeout):
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout
+
+    def _cache_file(self, physical_host):
+        digest = hashlib.sha1(SSH.to_bytes(physical_host)).hexdigest()
+        return os.path.join(self.path, '%s.json' % digest[:16])
+
+    def _read(self, cache_file):
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, physical_host, container_name):
+        """Return a (pid, start_time) tuple or None if unknown or stale.
+
+        Entries without a start time can not be checked, so they are treated
+        as stale.
+        """
+        entry = self._read(self._cache_file(physical_host)).get(container_name)
+        if not entry or not entry.get('start'):
+            return None
+        if time.time() - entry.get('time', 0) > self.timeout:
+            return None
+        return entry['pid'], entry.get('start')
+
+    @contextlib.contextmanager
+    def batch_lock(self, physical_host):
+        """Serialise batched lookups against a physical host.
+
+        Forks targeting sibling containers wait here while the first one
+        queries the physical host, then find their pid in the cache.
+        """
+        try:
+            makedirs_safe(self.path, 0o700)
+            lock = lock_file(self._cache_file(physical_host) + '.batch')
+        except (IOError, OSError):
+            yield
+            return
+        try:
+            yield
+        finally:
+            unlock_file(lock)
+
+    def _rewrite(self, cache_file, mutate):
+        """Apply mutate to the document in cache_file under an exclusive lock.
+
+        :param mutate: ``callable``  Takes the current document and returns
+                                     the document to store.
+        """
+        try:
+            makedirs_safe(self.path, 0o700)
+            lock = lock_file(cache_file + '.lock')
+            try:
+                data = mutate(self._read(cache_file))
+                fd, tmp_file = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.rename(tmp_file, cache_file)
+            finally:
+                unlock_file(lock)
+        except (IOError, OSError) as e:
+            SSH.display.vvv(u'Unable to update the container pid cache: %s'
+                            % SSH.to_text(e))
+
+    def update(self, physical_host, entries, remove=None, replace=False):
+        """Store new pids and drop stale ones for a physical host.
+
+        :param entries: ``dict``  Container name to (pid, start_time) tuples.
+        :param remove: ``list``  Container names to drop from the cache.
+        :param replace: ``bool``  Discard all entries not found in entries.
+        """
+        def _mutate(data):
+            if replace:
+                data = {}
+            now = time.time()
+            for name, (pid, start) in entries.items():
+                data[name] = {'pid': pid, 'start': start, 'time': now}
+            for name in remove or []:
+                data.pop(name, None)
+            return data
+
+        self._rewrite(self._cache_file(physical_host), _mutate)
+
+    def invalidate(self, physical_host, container_name):
+        self.update(physical_host, {}, remove=[container_name])
+
+    def count(self, name, value=1):
+        """Add value to a named counter kept alongside the cache."""
+        def _mutate(data):
+            data[name] = data.get(name, 0) + value
+            return data
+
+        self._rewrite(os.path.join(self.path, 'counters.json'), _mutate)
+
+    def counters(self):
+        return self._read(os.path.join(self.path, 'counters.json'))
+
+
+class StreamedFile(object):
+    """Destination of a streamed fetch.
+
+    The stream starts with one byte telling whether it resumes (R) the
+    content already in the file or holds the full file (F). The file is only
+    touched once that byte has arrived, and every attempt starts over from
+    the offset the stream was requested with, so a retried stream never
+    appends the same data twice.
+    """
+
+    def __init__(self, path, offset, compression):
+        self.path = path
+        self.resume_offset = offset
+        self.compression = compression
+        self.file = None
+        self.start()
+
+    def start(self):
+        """Reset the state for a new attempt."""
+        self.close()
+        self.file = None
+        self.offset = self.resume_offset
+        self.received = 0
+        self.written = 0
+        self.decompressor = None
+        if self.compression == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        """Write a chunk of the stream as received from ssh."""
+        self.received += len(data)
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        self._write(data)
+
+    def finish(self):
+        if self.decompressor:
+            self._write(self.decompressor.flush())
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    @property
+    def started(self):
+        return self.file is not None
+
+    def _write(self, data):
+        if self.file is None:
+            if not data:
+                return
+            if data[:1] == b'R':
+                self.file = open(self.path, 'r+b')
+                self.file.seek(self.offset)
+                self.file.truncate()
+            else:
+                self.offset = 0
+                self.file = open(self.path, 'wb')
+            data = data[1:]
+        self.file.write(data)
+        self.written += len(data)
+
+
 class Connection(SSH.Connection):
     """Transport options for containers.
 
@@ -83,7 +459,13 @@ class Connection(SSH.Connection):
 
         # Store the container pid for multi-use
         self.container_pid = None
+        self.container_pid_start = None
+        self.container_pid_cached = False
+        self.pid_cache = None
         self.is_container = None
+        self.round_trips_saved = 0
+        self.control_master_ready = False
+        self.open_spans = []
 
     def set_options(self, task_keys=None, var_options=None, direct=None):
 
@@ -120,29 +502,280 @@ class Connection(SSH.Connection):
             # Route SSH connection through the physical host address
             self.host = self._options['host'] = self._play_context.remote_addr = ph_addr
 
+            pid_cache = self.get_option('container_pid_cache')
+            if pid_cache:
+                self.pid_cache = ContainerPidCache(
+                    path=pid_cache,
+                    timeout=self.get_option('container_pid_cache_timeout')
+                )
+
     def exec_command(self, cmd, in_data=None, sudoable=True):
         """run a command on the remote host."""
 
-        if self.is_container:
-            # NOTE(hwoarang): the shlex_quote method is necessary here because
-            # we need to properly quote the cmd as it's being passed as argument
-            # to the -c su option. The Ansible ssh class has already
-            # quoted the command of the _executable_ (ie /bin/bash -c "$cmd").
-            # However, we also need to quote the executable itself because the
-            # entire command is being passed to the su process. This produces
-            # a somewhat ugly output with too many quotes in a row but we can't
-            # do much since we are effectively passing a command to a command
-            # to a command etc... It's somewhat ugly but maybe it can be
-            # improved somehow...
-            _pad = 'lxc-attach --clear-env --name %s' % self.container_name
-            cmd = '%s %s -- su - %s -c %s' % (
-                self._play_context.become_method,
-                _pad,
-                self.container_user,
-                shlex_quote(cmd)
+        if not self.is_container:
+            with self._timer('exec', 'ssh'):
+                return super(Connection, self).exec_command(
+                    cmd, in_data, sudoable
+                )
+
+        return self._container_exec(cmd, in_data, sudoable)
+
+    def _container_exec(self, cmd, in_data, sudoable, source=None):
+        """Run a command inside the container.
+
+        :param source: ``file``  Streamed to the command instead of in_data,
+                                 without reading it into memory.
+        """
+        exec_method = self.get_option('container_exec_method')
+        if exec_method == 'nsenter':
+            returncode, _ = self._pid_lookup()
+            if returncode != 0 or not self.container_pid_start:
+                SSH.display.vvv(u'Container pid unknown, falling back to'
+                                u' lxc-attach')
+                exec_method = 'lxc-attach'
+
+        if exec_method == 'nsenter':
+            container_cmd = self._nsenter_command(cmd)
+        else:
+            container_cmd = self._lxc_attach_command(cmd)
+
+        with self._timer('exec', exec_method):
+            if source is not None:
+                res = self._stream_run(
+                    self._build_command(self.get_option('ssh_executable'),
+                                        'ssh', self.host, container_cmd),
+                    source=source
+                )
+            else:
+                res = super(Connection, self).exec_command(
+                    container_cmd, in_data, sudoable
+                )
+
+        # NOTE: A cached pid which no longer belongs to the container is
+        # caught by the start time check before nsenter runs. Look the pid
+        # up again and retry once.
+        if exec_method == 'nsenter' and res[0] != 0 and \
+                SSH.to_bytes(STALE_PID_MARKER) in res[2] and \
+                self._pid_invalidate():
+            return self._container_exec(cmd, in_data, sudoable, source)
+
+        return res
+
+    def _lxc_attach_command(self, cmd):
+        """Return cmd wrapped to run inside the container via lxc-attach."""
+        # NOTE(hwoarang): the shlex_quote method is necessary here because
+        # we need to properly quote the cmd as it's being passed as argument
+        # to the -c su option. The Ansible ssh class has already
+        # quoted the command of the _executable_ (ie /bin/bash -c "$cmd").
+        # However, we also need to quote the executable itself because the
+        # entire command is being passed to the su process. This produces
+        # a somewhat ugly output with too many quotes in a row but we can't
+        # do much since we are effectively passing a command to a command
+        # to a command etc... It's somewhat ugly but maybe it can be
+        # improved somehow...
+        _pad = 'lxc-attach --clear-env --name %s' % self.container_name
+        return '%s %s -- su - %s -c %s' % (
+            self._play_context.become_method,
+            _pad,
+            self.container_user,
+            shlex_quote(cmd)
+        )
+
+    def _nsenter_command(self, cmd):
+        """Return cmd wrapped to run inside the container via nsenter.
+
+        The namespaces of the container init process are entered directly,
+        which avoids forking lxc-attach for every command. A login shell is
+        only started when the command has to run as a user other than root.
+        The pid start time is checked first so that a recycled pid is never
+        entered.
+        """
+        _pad = 'nsenter --target %s %s -- env -i %s' % (
+            self.container_pid,
+            NSENTER_NAMESPACES,
+            NSENTER_ENVIRONMENT
+        )
+        if self.container_user == 'root':
+            _exec = '/bin/sh -c %s' % shlex_quote(cmd)
+        else:
+            _exec = 'su - %s -c %s' % (self.container_user, shlex_quote(cmd))
+        return '%s; %s %s %s' % (
+            self._pid_guard(),
+            self._play_context.become_method,
+            _pad,
+            _exec
+        )
+
+    def _pid_guard(self):
+        """Return a command exiting with STALE_PID_MARKER on a recycled pid.
+
+        The command compares the start time of the container pid with the
+        one recorded when the pid was looked up. A pid without a start time
+        is never trusted.
+        """
+        return (
+            '[ -n %s ] && [ "$(sed \'s/.*) //\' /proc/%s/stat 2>/dev/null | '
+            'cut -d\' \' -f20)" = %s ] || { echo %s >&2; exit 1; }' % (
+                shlex_quote(self.container_pid_start or ''),
+                self.container_pid,
+                shlex_quote(self.container_pid_start or ''),
+                STALE_PID_MARKER
+            )
+        )
+
+    @contextlib.contextmanager
+    def _timer(self, phase, detail=None):
+        """Time the wrapped block.
+
+        The duration is reported at verbosity level 3 and, when timing_log
+        is set, appended to that file as a JSON span. The block may add
+        extra fields to the span through the yielded dict. A span started
+        within another one records the name of the enclosing span as its
+        parent, since its duration is already part of that span.
+        """
+        start = time.time()
+        extra = {}
+        name = '%s (%s)' % (phase, detail) if detail else phase
+        parent = self.open_spans[-1] if self.open_spans else None
+        self.open_spans.append(name)
+        try:
+            yield extra
+        finally:
+            self.open_spans.pop()
+            duration = time.time() - start
+            SSH.display.vvv(
+                u'%s%s took %.3fs' % (
+                    phase,
+                    ' (%s)' % detail if detail else '',
+                    duration
+                ),
+                host=self.host
             )
+            timing_log = self.get_option('timing_log')
+            if timing_log:
+                self._write_span(timing_log, {
+                    'time': start,
+                    'phase': phase,
+                    'detail': detail,
+                    'parent': parent,
+                    'host': self.host,
+                    'physical_host': self.physical_host or self.host,
+                    'container': self.container_name if self.is_container
+                    else None,
+                    'duration': duration,
+                    **extra
+                })
 
-        return super(Connection, self).exec_command(cmd, in_data, sudoable)
+    @staticmethod
+    def _write_span(timing_log, span):
+        """Append a span to the timing log.
+
+        Each span is written with a single append so lines from concurrent
+        forks never interleave.
+        """
+        line = SSH.to_bytes(json.dumps(span, sort_keys=True) + '\n')
+        try:
+            fd = os.open(os.path.expanduser(timing_log),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            SSH.display.vvv(u'Unable to write to the timing log: %s'
+                            % SSH.to_text(e))
+
+    def _bare_run(self, cmd, in_data, sudoable=True, checkrc=True):
+        self._control_master_check()
+        return super(Connection, self)._bare_run(
+            cmd, in_data, sudoable=sudoable, checkrc=checkrc
+        )
+
+    @SSH._ssh_retry
+    def _stream_run(self, cmd, sink=None, source=None):
+        """Run cmd, streaming its input and output instead of buffering them.
+
+        This is _run for transfers too large to be held in memory like
+        _bare_run does. It shares the retries and the ControlMaster
+        handling, but does not support password authentication.
+
+        :param sink: ``StreamedFile``  Receives stdout as it arrives and is
+                                       restarted on every attempt. Without a
+                                       sink, stdout is returned.
+        :param source: ``file``  Fed to stdin, rewound on every attempt.
+        """
+        self._control_master_check()
+        stdin = subprocess.DEVNULL
+        if source is not None:
+            source.seek(0)
+            stdin = source
+        with tempfile.TemporaryFile() as out_file, \
+                tempfile.TemporaryFile() as err_file:
+            p = subprocess.Popen(cmd, stdin=stdin, stderr=err_file,
+                                 stdout=out_file if sink is None
+                                 else subprocess.PIPE)
+            try:
+                if sink is not None:
+                    sink.start()
+                    for chunk in iter(lambda: p.stdout.read(SSH.BUFSIZE),
+                                      b''):
+                        sink.write(chunk)
+                    sink.finish()
+            finally:
+                if sink is not None:
+                    sink.close()
+                if p.poll() is None and sink is not None:
+                    p.kill()
+                returncode = p.wait()
+            out_file.seek(0)
+            err_file.seek(0)
+            return returncode, out_file.read(), err_file.read()
+
+    def _control_master_check(self):
+        if self.is_container and not self.control_master_ready and \
+                self.get_option('container_shared_control_master'):
+            self._control_master_warmup()
+
+    def _control_master_warmup(self):
+        """Open the ControlMaster to the physical host once for all forks.
+
+        Every container on a physical host is reached through the same
+        address and user, so they all share one ControlPath. When a play
+        starts, the forks for sibling containers race to create that socket
+        and the losers fall back to opening their own connection. Here the
+        first fork opens the master under a lock while the others wait, then
+        every fork multiplexes over it.
+        """
+        self.control_master_ready = True
+
+        # Build a command first so the ControlPath settings are resolved.
+        warmup_cmd = self._build_command(
+            self.get_option('ssh_executable'), 'ssh', self.host, 'true'
+        )
+        if not getattr(self, '_persistent', False) or not self.control_path:
+            return
+
+        socket_path = self.control_path % dict(
+            directory=unfrackpath(self.control_path_dir)
+        )
+        # Paths using ssh tokens (%C, %h, ...) can not be checked locally.
+        if '%' in socket_path or os.path.exists(socket_path):
+            return
+
+        try:
+            lock = lock_file(socket_path + '.lock')
+        except (IOError, OSError):
+            return
+        try:
+            if not os.path.exists(socket_path):
+                SSH.display.vvv(u'Opening shared ControlMaster %s'
+                                % socket_path, host=self.host)
+                with self._timer('control_master'):
+                    super(Connection, self)._bare_run(
+                        warmup_cmd, None, sudoable=False, checkrc=False
+                    )
+        finally:
+            unlock_file(lock)
 
     def _container_check(self):
         if self.container_name is not None:
@@ -162,8 +795,9 @@ class Connection(SSH.Connection):
         """Lookup the container pid return padding.
 
         The container pid path will be set and returned to the
-        function. If this is a new lookup, the method will run
-        a lookup command and set the "self.container_pid" variable
+        function. If this is a new lookup, the method will consult the
+        pid cache shared between forks and only run a lookup command when
+        the container is unknown, setting the "self.container_pid" variable
         so that a container lookup is not required on a subsequent
         command within the same task.
         """
@@ -171,29 +805,103 @@ class Connection(SSH.Connection):
         if not subdir:
             subdir = 'root'
 
+        returncode = 0
+        if not self.container_pid and self.pid_cache:
+            if self.get_option('container_pid_batch'):
+                with self.pid_cache.batch_lock(self.host):
+                    if not self._pid_from_cache():
+                        self._pid_lookup_batch()
+            else:
+                self._pid_from_cache()
+
         if not self.container_pid:
-            ssh_executable = self.get_option('ssh_executable')
-            lookup_command = (u"lxc-info -Hpn '%s'" % self.container_name)
-            args = (ssh_executable, 'ssh', self.host, lookup_command)
+            returncode = self._pid_query(
+                PID_LOOKUP_COMMAND % self.container_name
+            )
+
+        return returncode, os.path.join(
+            pid_path % SSH.to_text(self.container_pid),
+            subdir
+        )
+
+    def _pid_query(self, command, detail=None):
+        """Run a pid lookup command and record the pid it prints."""
+        ssh_executable = self.get_option('ssh_executable')
+        args = (ssh_executable, 'ssh', self.host, command)
+        with self._timer('pid_lookup', detail):
             returncode, stdout, _ = self._run(
                 self._build_command(*args),
                 in_data=None,
                 sudoable=False
             )
-            self.container_pid = stdout.strip()
-            pid_path = os.path.join(
-                pid_path % SSH.to_text(self.container_pid),
-                subdir
-            )
-            return returncode, pid_path
-        else:
-            return 0, os.path.join(
-                pid_path % SSH.to_text(self.container_pid),
-                subdir
+        lookup = SSH.to_text(stdout).split()
+        if returncode == 0 and lookup:
+            pid = (lookup[0], (lookup[1:] or [None])[0])
+            changed = pid != (self.container_pid, self.container_pid_start)
+            self.container_pid, self.container_pid_start = pid
+            self.container_pid_cached = False
+            if self.pid_cache and changed:
+                self.pid_cache.update(self.host, {self.container_name: pid})
+        elif returncode == 0:
+            returncode = 1
+        return returncode
+
+    def _pid_from_cache(self):
+        """Load the container pid from the pid cache if it is known."""
+        cached = self.pid_cache.get(self.host, self.container_name)
+        if cached:
+            SSH.display.vvv(u'Container pid found in cache: %s' % cached[0])
+            self.container_pid, self.container_pid_start = cached
+            self.container_pid_cached = True
+        return self.container_pid
+
+    def _pid_lookup_batch(self):
+        """Lookup the pid of every running container on the physical host.
+
+        All pids are stored in the pid cache so that connections to sibling
+        containers on the same physical host do not need a lookup of their
+        own.
+        """
+        ssh_executable = self.get_option('ssh_executable')
+        args = (ssh_executable, 'ssh', self.host, PID_BATCH_LOOKUP_COMMAND)
+        with self._timer('pid_lookup', 'batch'):
+            returncode, stdout, _ = self._run(
+                self._build_command(*args),
+                in_data=None,
+                sudoable=False
             )
+        if returncode != 0:
+            return
+
+        entries = {}
+        for line in SSH.to_text(stdout).splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                entries[fields[0]] = (fields[1], (fields[2:] or [None])[0])
+        SSH.display.vvv(u'Batch lookup found %d containers on %s'
+                        % (len(entries), self.host))
+        self.pid_cache.update(self.host, entries, replace=True)
+
+        if self.container_name in entries:
+            self.container_pid, self.container_pid_start = \
+                entries[self.container_name]
+            self.container_pid_cached = False
+
+    def _pid_invalidate(self):
+        """Forget the container pid, returning True if it came from cache."""
+        cached = self.container_pid_cached
+        if cached and self.pid_cache:
+            SSH.display.vvv(u'Dropping cached container pid: %s'
+                            % self.container_pid)
+            self.pid_cache.invalidate(self.host, self.container_name)
+        self.container_pid = None
+        self.container_pid_start = None
+        self.container_pid_cached = False
+        return cached
 
     def _container_path_pad(self, path):
-        returncode, pid_path = self._pid_lookup()
+        with self._timer('path_pad'):
+            returncode, pid_path = self._pid_lookup()
         if returncode == 0:
             pad = os.path.join(
                 pid_path,
@@ -207,32 +915,282 @@ class Connection(SSH.Connection):
         else:
             return path
 
+    def _stale_pid_retry(self, transfer):
+        """Run a container file transfer, retrying once on a stale pid.
+
+        A cached pid may belong to a container which has been restarted
+        since it was cached, in which case the padded path no longer exists
+        or, for streamed fetches, the start time check fails. The pid is
+        looked up again and the transfer retried once.
+        """
+        try:
+            return transfer()
+        except AnsibleError:
+            if not self._pid_invalidate():
+                raise
+            return transfer()
+
     def fetch_file(self, in_path, out_path):
         """fetch a file from remote to local."""
-        if self.is_container:
-            in_path = self._container_path_pad(path=in_path)
+        if not self.is_container:
+            with self._timer('fetch', 'ssh'):
+                return super(Connection, self).fetch_file(in_path, out_path)
+
+        if self.get_option('container_fetch_method') == 'stream' and \
+                not self.get_option('password'):
+            return self._stale_pid_retry(
+                lambda: self._fetch_file_stream(
+                    self._container_path_pad(path=in_path),
+                    out_path
+                )
+            )
+
+        with self._timer('fetch', 'transfer'):
+            return self._stale_pid_retry(
+                lambda: super(Connection, self).fetch_file(
+                    self._container_path_pad(path=in_path),
+                    out_path
+                )
+            )
 
-        return super(Connection, self).fetch_file(in_path, out_path)
+    def _fetch_file_stream(self, in_path, out_path):
+        """Stream a file from the remote host straight into out_path.
+
+        The file is read with tail over a plain ssh session, optionally
+        compressed with gzip on the remote end and decompressed here while
+        it is written, so it never has to fit in memory or be staged in a
+        temporary file. When resume is enabled and out_path already exists,
+        only the bytes past its current size are fetched, provided the
+        remote file still starts with the content of out_path. The stream
+        starts with one byte telling whether it resumes (R) or holds the
+        full file (F).
+        """
+        compression = self.get_option('container_fetch_compression')
+        resume = self.get_option('container_fetch_resume')
+        offset = 0
+        if resume and os.path.exists(out_path):
+            offset = os.path.getsize(out_path)
+
+        quoted_path = shlex_quote(in_path)
+        read = u'{ tail -c +%%d %s || echo %s >&2; }' % (
+            quoted_path, STREAM_FAILED_MARKER
+        )
+        if offset:
+            digest = hashlib.sha1()
+            with open(out_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(SSH.BUFSIZE), b''):
+                    digest.update(chunk)
+            stream = (
+                u'if [ "$(head -c %d %s | sha1sum | cut -d" " -f1)" = %s ];'
+                u' then printf R; %s; else printf F; %s; fi' % (
+                    offset, quoted_path, digest.hexdigest(),
+                    read % (offset + 1), read % 1
+                )
+            )
+        else:
+            stream = u'printf F; %s' % (read % 1)
+        remote_cmd = u'test -r %s && { %s; }' % (quoted_path, stream)
+        if self.container_pid:
+            # in_path is padded with the container pid, which may be cached.
+            remote_cmd = u'%s; %s' % (self._pid_guard(), remote_cmd)
+        if compression == 'gzip':
+            remote_cmd += ' | gzip -c -1'
+
+        SSH.display.vvv(u'FETCH %s TO %s (stream, offset %d, compression %s)'
+                        % (in_path, out_path, offset, compression),
+                        host=self.host)
+        cmd = self._build_command(
+            self.get_option('ssh_executable'), 'ssh', self.host, remote_cmd
+        )
+        sink = StreamedFile(out_path, offset, compression)
+        start = time.time()
+        try:
+            with self._timer('fetch', 'stream') as span:
+                try:
+                    returncode, _, stderr = self._stream_run(cmd, sink)
+                finally:
+                    span.update(bytes_received=sink.received,
+                                bytes_written=sink.written,
+                                offset=sink.offset)
+            if returncode != 0 or not sink.started or \
+                    SSH.to_bytes(STREAM_FAILED_MARKER) in stderr:
+                raise AnsibleError(
+                    'failed to stream file %s to %s:\n%s' % (
+                        SSH.to_native(in_path), SSH.to_native(out_path),
+                        SSH.to_native(stderr)
+                    )
+                )
+        except Exception:
+            if not resume and os.path.exists(out_path):
+                os.unlink(out_path)
+            raise
+
+        SSH.display.vvv(
+            u'Fetched %d bytes (%d on the wire) at %.1f MiB/s' % (
+                sink.written, sink.received,
+                sink.written / max(time.time() - start, 1e-6) / 1048576
+            ),
+            host=self.host
+        )
+        return returncode, b'', stderr
+
+    def _put_file_fused(self, in_path, out_path):
+        """Write a file into the container and chown it in one round-trip.
+
+        The file is streamed over stdin to a command run inside the container
+        as root, which writes it and sets the ownership to container_user.
+        This replaces the separate put and chown commands otherwise needed
+        when container_user differs from remote_user.
+        """
+        SSH.display.vvv(u'PUT %s TO %s (with chown to %s)'
+                        % (in_path, out_path, self.container_user),
+                        host=self.host)
+        with open(in_path, 'rb') as f:
+            in_data = f.read()
+
+        _user = self.container_user
+        self.container_user = 'root'
+        try:
+            with self._timer('put', 'fused'):
+                returncode, stdout, stderr = self.exec_command(
+                    'cat > %s && chown %s %s' % (
+                        shlex_quote(out_path),
+                        shlex_quote(_user),
+                        shlex_quote(out_path)
+                    ),
+                    in_data=in_data,
+                    sudoable=False
+                )
+        finally:
+            self.container_user = _user
+
+        if returncode != 0:
+            raise AnsibleError(
+                'failed to transfer file to %s %s:\n%s\n%s' % (
+                    SSH.to_native(in_path), SSH.to_native(out_path),
+                    SSH.to_native(stdout), SSH.to_native(stderr)
+                )
+            )
+
+        self.round_trips_saved += 1
+        if self.pid_cache:
+            self.pid_cache.count('put_chown_round_trips_saved')
+        SSH.display.vvv(u'Saved %d round-trip(s) by fusing chown into put'
+                        % self.round_trips_saved, host=self.host)
+        return returncode, stdout, stderr
 
     def put_file(self, in_path, out_path):
         """transfer a file from local to remote."""
         _out_path = os.path.expanduser(out_path)
-        if self.is_container:
-            _out_path = self._container_path_pad(path=_out_path)
-
-        res = super(Connection, self).put_file(in_path, _out_path)
 
         # NOTE(mnaser): If we're running without a container, we break out
         #               here to avoid the extra round-trip for the unnecessary
         #               chown.
         if not self.is_container:
-            return res
+            with self._timer('put', 'ssh'):
+                return super(Connection, self).put_file(in_path, _out_path)
+
+        chown = self.container_user != self._play_context.remote_user
+        if chown and os.path.getsize(in_path) <= PUT_FUSED_MAX_SIZE:
+            return self._put_file_fused(in_path, _out_path)
+
+        with self._timer('put', 'transfer'):
+            res = self._stale_pid_retry(
+                lambda: super(Connection, self).put_file(
+                    in_path,
+                    self._container_path_pad(path=_out_path)
+                )
+            )
 
         # NOTE(pabelanger): Because we put_file as remote_user, it is possible
         # that user doesn't exist inside the container, so use the root user to
         # chown the file to container_user.
-        if self.container_user != self._play_context.remote_user:
+        if chown:
             _user = self.container_user
             self.container_user = 'root'
-            self.exec_command('chown %s %s' % (_user, out_path))
+            with self._timer('chown'):
+                self.exec_command('chown %s %s' % (_user, out_path))
             self.container_user = _user
+
+        return res
+
+    def put_files(self, files):
+        """Transfer many files to the remote host in a single round-trip.
+
+        The files are packed into one tar archive which is streamed to tar
+        running as root inside the container. The archive is spooled to a
+        temporary file on the deployment host and fed to ssh from there.
+        With password authentication it is read into memory instead, as the
+        password has to be passed through the same machinery as the data.
+
+        Only container targets are supported: elsewhere tar would run as
+        remote_user without become and could not set the owners and modes.
+        The openstack.osa.put_files action plugin calls it.
+
+        :param files: ``list``  Tuples of (src, dest, owner, mode). ``owner``
+                                may be ``user`` or ``user:group`` and defaults
+                                to container_user. ``mode`` may be an int or
+                                an octal string and defaults to the mode of
+                                src.
+        """
+        if not self.is_container:
+            raise AnsibleError(
+                'put_files is only supported for container targets, use'
+                ' put_file for %s' % self.host
+            )
+
+        with tempfile.TemporaryFile() as archive:
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                for src, dest, owner, mode in files:
+                    info = tar.gettarinfo(src, arcname=os.path.expanduser(
+                        dest).lstrip(os.sep))
+                    user, _, group = \
+                        (owner or self.container_user).partition(':')
+                    info.uid = info.gid = 0
+                    info.uname = user
+                    info.gname = group or user
+                    if mode is not None:
+                        info.mode = int(str(mode), 8) \
+                            if not isinstance(mode, int) else mode
+                    with open(src, 'rb') as f:
+                        tar.addfile(info, f)
+
+            SSH.display.vvv(u'PUT %d files in one archive' % len(files),
+                            host=self.host)
+            _user = self.container_user
+            self.container_user = 'root'
+            try:
+                with self._timer('put', 'bulk'):
+                    if self.get_option('password'):
+                        archive.seek(0)
+                        returncode, stdout, stderr = self.exec_command(
+                            'tar -x -p -f - -C /',
+                            in_data=archive.read(),
+                            sudoable=False
+                        )
+                    else:
+                        returncode, stdout, stderr = self._container_exec(
+                            'tar -x -p -f - -C /', None, False,
+                            source=archive
+                        )
+            finally:
+                self.container_user = _user
+
+        if returncode != 0:
+            raise AnsibleError(
+                'failed to transfer %d files:\n%s\n%s' % (
+                    len(files), SSH.to_native(stdout), SSH.to_native(stderr)
+                )
+            )
+
+        # Each file would otherwise cost a put, and a chown when
+        # container_user differs from remote_user.
+        per_file = 1
+        if self.container_user != self._play_context.remote_user:
+            per_file = 2
+        saved = len(files) * per_file - 1
+        if saved > 0:
+            self.round_trips_saved += saved
+            if self.pid_cache:
+                self.pid_cache.count('bulk_put_round_trips_saved', saved)
+        return returncode, stdout, stderr
@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import AnsibleModule
+from concurrent import futures
+import collections
+import contextlib
+import fcntl
 import git
+import hashlib
 import itertools
-import multiprocessing
 import os
-import signal
+import random
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
 import time
+from urllib.parse import urlparse
 
 DOCUMENTATION = """
 ---
@@ -26,6 +36,10 @@ options:
         "depth" - clone depth level
         "shallow_since" - get repo history starting from that date
         "force" - require git clone uses "--force"
+        "filter" - partial clone filter, e.g. "blob:none"
+        "sparse_paths" - list of directories to check out
+                         with sparse-checkout, existing repos
+                         without it get a full checkout again
   default_path:
     description:
       Default git clone path (str) in case not
@@ -48,6 +62,35 @@ options:
       Default clone depth (int) in case not specified
       on an individual repo basis. Defaults to None.
       Not required.
+  bundle_path:
+    description:
+      Directory (path) of git bundles, or a tar archive
+      of them, named after the repos as "<name>.bundle".
+      Repos with a bundle are cloned or updated from it
+      instead of their "src", and the remote URL is set
+      back to "src" afterwards, so no network access is
+      needed for them. Repos without a bundle use their
+      "src" as usual. Defaults to None. Not required.
+  bundle_create:
+    description:
+      Directory (path) in which to write one
+      "<name>.bundle" per repo after cloning, holding
+      HEAD and the requested version, for use with
+      bundle_path at another site. Shallow clones cannot
+      be bundled and are skipped with a warning. A path
+      ending in ".tar" or ".tar.gz" writes a single tar
+      archive of the bundles instead. Defaults to None.
+      Not required.
+  default_filter:
+    description:
+      Default partial clone filter (str), such as
+      "blob:none" or "tree:0", in case not specified
+      on an individual repo basis. Unlike depth, a
+      filter keeps the full commit history, so tags
+      still resolve, and missing objects are fetched
+      on demand. Existing clones are converted to
+      partial clones on their next fetch. Defaults to
+      None. Not required.
   default_shallow_since:
     description:
       Default shallow date (str) strating from which
@@ -60,9 +103,10 @@ options:
       clone failure. Defaults to 1. Not required.
   delay:
     description:
-      Integer time delay (seconds) between git clone
-      retries in case of failure. Defaults to 0. Not
-      required.
+      Integer base time delay (seconds) between git clone
+      retries in case of failure. The delay doubles with
+      every retry and gets a random jitter of up to one
+      base delay added. Defaults to 0. Not required.
   force:
     description:
       Boolean. Apply --force flags to git clones wherever
@@ -80,6 +124,26 @@ options:
       used for multithreading. Use of too many cores
       simultaneously will cause file decscriptors
       to be exhausted. Defaults to 16. Not required.
+  host_maximum:
+    description:
+      Integer maximum number of concurrent git operations
+      against any single remote host. The limit for a
+      host is halved whenever an operation against it
+      fails and grows back by one with every success,
+      so a struggling git server is throttled. Defaults
+      to the number of threads, so a single host is not
+      capped until it fails. Not required.
+  reference_cache:
+    description:
+      Directory (path) holding one bare mirror of every
+      unique "src". Mirrors are created or fetched once
+      per run, under a lock, before any repo is cloned,
+      and every clone then borrows their objects through
+      git alternates, so only the mirror talks to the
+      remote. The mirrors are never garbage collected;
+      do not remove the directory while clones made from
+      it are still in use. Defaults to None. Not
+      required.
 """
 
 EXAMPLES = """
@@ -89,16 +153,243 @@ EXAMPLES = """
     repo_info: "[{'src':'https://github.com/ansible/',
                   'name': 'ansible'
                   'dest': '/etc/opt/ansible'}]"
+
+- name: Clone repos borrowing objects from a local mirror cache
+  git_requirements:
+    default_path: /etc/ansible/roles
+    reference_cache: /var/cache/git-mirrors
+    repo_info: "{{ role_requirements }}"
+
+- name: Clone repos without blobs, checking out a subset of one
+  git_requirements:
+    default_path: /etc/ansible/roles
+    default_filter: "blob:none"
+    repo_info:
+      - name: openstack_hosts
+        src: https://opendev.org/openstack/openstack-ansible-openstack_hosts
+        version: master
+      - name: requirements
+        src: https://opendev.org/openstack/requirements
+        version: master
+        filter: "tree:0"
+        sparse_paths:
+          - openstack_requirements
+
+- name: Clone repos and report the slowest ones
+  git_requirements:
+    default_path: /etc/ansible/roles
+    repo_info: "{{ role_requirements }}"
+  register: git_clone
+
+# Every entry in git_clone.repos has the action taken (clone, fetch,
+# checkout or noop), its elapsed time, the bytes received, the retries used
+# and the final commit. git_clone.stats has the totals.
+- name: Show the slowest repos
+  debug:
+    msg: "{{ git_clone.stats.slowest }}"
+
+- name: Preview which repos would be cloned, fetched or checked out
+  git_requirements:
+    default_path: /etc/ansible/roles
+    repo_info: "{{ role_requirements }}"
+  check_mode: true
+  register: git_plan
+
+- name: Clone repos and bundle them for an air-gapped site
+  git_requirements:
+    default_path: /etc/ansible/roles
+    default_filter: "blob:none"
+    bundle_create: /srv/offline/role-bundles.tar.gz
+    repo_info: "{{ role_requirements }}"
+
+- name: Clone repos from bundles prepared at a connected site
+  git_requirements:
+    default_path: /etc/ansible/roles
+    bundle_path: /srv/offline/role-bundles.tar.gz
+    repo_info: "{{ role_requirements }}"
 """
 
 
-def init_signal():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+class HostLimiter(object):
+    """Bound the number of concurrent git operations per remote host."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.condition = threading.Condition()
+        self.limits = {}
+        self.active = collections.defaultdict(int)
+
+    @staticmethod
+    def host(src):
+        parsed = urlparse(src)
+        if parsed.scheme:
+            return parsed.hostname or ""
+        # scp-like syntax, e.g. git@example.com:path/to/repo
+        match = re.match(r"^(?:[^@/]+@)?([^:/]+):", src)
+        return match.group(1) if match else ""
+
+    def acquire(self, src):
+        host = self.host(src)
+        with self.condition:
+            while self.active[host] >= self.limits.get(host, self.maximum):
+                self.condition.wait()
+            self.active[host] += 1
+
+    def release(self, src, success=True):
+        host = self.host(src)
+        with self.condition:
+            self.active[host] -= 1
+            limit = self.limits.get(host, self.maximum)
+            if success:
+                self.limits[host] = min(limit + 1, self.maximum)
+            else:
+                self.limits[host] = max(limit // 2, 1)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, src):
+        """Hold a slot for src, the host limit shrinks if the block fails.
+
+        The block fails when it raises, or when it sets the "success" key
+        of the yielded dict to False.
+        """
+        self.acquire(src)
+        outcome = {"success": False}
+        try:
+            outcome["success"] = True
+            yield outcome
+        except Exception:
+            outcome["success"] = False
+            raise
+        finally:
+            self.release(src, outcome["success"])
+
+
+def backoff(delay, attempt):
+    base = delay * 2 ** attempt
+    return base + random.uniform(0, delay)
+
+
+def mirror_path(cache, src):
+    name = os.path.basename(src.rstrip("/"))
+    if name.endswith(".git"):
+        name = name[:-4]
+    src_hash = hashlib.sha1(src.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache, "%s-%s.git" % (name, src_hash))
+
+
+def update_mirror(info):
+    src, mirror, limiter = info
+    requested = time.time()
+    stamp = mirror + ".updated"
+    try:
+        with open(mirror + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another run may have refreshed the mirror while we waited for
+            # the lock, in which case there is nothing left to fetch.
+            if os.path.exists(stamp) and os.path.getmtime(stamp) >= requested:
+                return None
+            with limiter.slot(src):
+                if os.path.isdir(mirror):
+                    git.Repo(mirror).git.fetch("origin", force=True)
+                else:
+                    tmp_mirror = mirror + ".tmp"
+                    shutil.rmtree(tmp_mirror, ignore_errors=True)
+                    repo = git.Repo.clone_from(src, tmp_mirror, mirror=True)
+                    # Clones borrow objects from the mirror, so it must never
+                    # prune anything they may still depend on.
+                    repo.git.config("gc.auto", "0")
+                    os.rename(tmp_mirror, mirror)
+            with open(stamp, "w"):
+                pass
+    except Exception as e:
+        return "Failed to update mirror %s of %s\n%s" % (mirror, src, str(e))
+    return None
+
+
+def add_reference(repo, reference):
+    alternates = os.path.join(repo.git_dir, "objects", "info", "alternates")
+    objects = os.path.join(reference, "objects")
+    try:
+        with open(alternates) as f:
+            if objects in f.read().splitlines():
+                return
+    except IOError:
+        pass
+    with open(alternates, "a") as f:
+        f.write(objects + "\n")
+
+
+def list_remote(info):
+    src, url, limiter = info
+    refs = {}
+    try:
+        with limiter.slot(url):
+            output = git.Git().ls_remote(url)
+    except Exception:
+        return src, None
+    for line in output.splitlines():
+        commit, _, ref = line.partition("\t")
+        refs[ref] = commit
+    return src, refs
+
+
+def resolve_version(version, refs):
+    # If the version is the length of a hash then treat is as one
+    if len(version) == 40:
+        return version
+    if refs is None:
+        return None
+    # Peeled tags come first so annotated tags resolve to their commit
+    for ref in ("refs/heads/%s" % version,
+                "refs/tags/%s^{}" % version,
+                "refs/tags/%s" % version,
+                version):
+        if ref in refs:
+            return refs[ref]
+    return None
+
+
+def head_commit(repo):
+    try:
+        return repo.head.commit.hexsha
+    except Exception:
+        return None
+
+
+def get_sparse_paths(repo):
+    """Return the sparse paths of the working tree, None if it is full."""
+    try:
+        return repo.git.sparse_checkout("list").splitlines()
+    except git.GitCommandError:
+        # Not a sparse worktree
+        return None
+
+
+def sparse_paths_changed(repo, paths):
+    current = get_sparse_paths(repo)
+    if not paths:
+        return current is not None
+    return current is None or sorted(current) != sorted(paths)
+
+
+def set_sparse_paths(repo, paths):
+    """Limit the working tree to paths, returning whether it changed.
+
+    Without paths a sparse working tree is restored to a full one.
+    """
+    if not sparse_paths_changed(repo, paths):
+        return False
+    if paths:
+        repo.git.sparse_checkout("set", *paths)
+    else:
+        repo.git.sparse_checkout("disable")
+    return True
 
 
 def check_out_version(repo, version, pull=False, fetch=True, force=False,
                       refspec=None, tag=False, depth=None,
-                      shallow_since=None):
+                      shallow_since=None, filter=None):
     # If a refspec is defined, we must always fetch to ensure the ref is
     # available locally, regardless of the 'fetch' parameter.
     if refspec:
@@ -112,7 +403,8 @@ def check_out_version(repo, version, pull=False, fetch=True, force=False,
                 'tags': tag,
                 'force': force,
                 'depth': depth,
-                'shallow_since': shallow_since
+                'shallow_since': shallow_since,
+                'filter': filter
             }
             if refspec:
                 remote_name = repo.remotes[0].name if repo.remotes else 'origin'
@@ -155,19 +447,206 @@ def check_out_version(repo, version, pull=False, fetch=True, force=False,
     return []
 
 
+def extract_bundles(archive):
+    directory = tempfile.mkdtemp(prefix="git_requirements_")
+    with tarfile.open(archive) as tar:
+        for member in tar.getmembers():
+            # Only take bundles, flattened, so that no member can be
+            # written outside of the temporary directory.
+            if not member.isfile() or not member.name.endswith(".bundle"):
+                continue
+            member.name = os.path.basename(member.name)
+            tar.extract(member, directory)
+    return directory
+
+
+def create_bundle(info):
+    role, directory = info
+    bundle = os.path.join(directory, "%s.bundle" % role["name"])
+    try:
+        repo = git.Repo(role["dest"])
+        if os.path.exists(os.path.join(repo.git_dir, "shallow")):
+            return ("Not creating bundle %s, %s is a shallow clone; use a "
+                    "filter instead of depth or shallow_since" %
+                    (bundle, role["dest"]))
+        refs = ["HEAD"]
+        for ref in ("refs/heads/%s", "refs/tags/%s"):
+            ref = ref % role["version"]
+            try:
+                repo.git.rev_parse(ref, verify=True, quiet=True)
+            except git.GitCommandError:
+                continue
+            refs.append(ref)
+        repo.git.bundle("create", bundle + ".tmp", *refs)
+        os.rename(bundle + ".tmp", bundle)
+    except Exception as e:
+        return "Failed to create bundle %s\n%s" % (bundle, str(e))
+    return None
+
+
+def write_bundles(git_repos, executor, destination):
+    archive = None
+    if destination.endswith((".tar", ".tar.gz")):
+        archive = destination
+        destination = tempfile.mkdtemp(prefix="git_requirements_")
+    elif not os.path.isdir(destination):
+        os.makedirs(destination)
+    try:
+        warnings = [warning for warning in executor.map(
+            create_bundle, [(repo, destination) for repo in git_repos])
+            if warning]
+        if archive:
+            mode = "w:gz" if archive.endswith(".gz") else "w"
+            with tarfile.open(archive, mode) as tar:
+                for name in sorted(os.listdir(destination)):
+                    tar.add(os.path.join(destination, name), arcname=name)
+    finally:
+        if archive:
+            shutil.rmtree(destination, ignore_errors=True)
+    return warnings
+
+
+def objects_size(dest):
+    total = 0
+    for root, _, files in os.walk(os.path.join(dest, ".git", "objects")):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
 def pull_wrapper(info):
-    role_info = info
-    retries = info[1]["retries"]
-    delay = info[1]["delay"]
+    role, config, limiter = info
+    retries = config["retries"]
+    delay = config["delay"]
+    failures = []
+    result = {
+        "name": role["name"],
+        "dest": role["dest"],
+        "version": role["version"],
+        "action": None,
+        "changed": False,
+        "commit": None,
+        "retries": 0,
+        "started": time.time()
+    }
+    # Objects borrowed through alternates are not counted, so this is close
+    # to what was actually received from the remote.
+    size = objects_size(role["dest"])
+    # A bundle stands in for the remote, it already holds the version so
+    # no refspec has to be fetched.
+    work = role
+    if role.get("bundle"):
+        work = dict(role, src=role["bundle"], refspec=None)
     for i in range(retries):
-        success = pull_role(role_info)
+        result["retries"] = i
+        try:
+            with limiter.slot(work["src"]) as outcome:
+                success, action = pull_role((work, config, failures))
+                outcome["success"] = success
+        except Exception as e:
+            success = False
+            failures.append("Failed to pull %s into %s\n%s" %
+                            (work["src"], role["dest"], str(e)))
         if success:
-            return True
+            result["action"] = action
+            result["changed"] = action in ("clone", "checkout")
+            break
+        elif i + 1 < retries:
+            time.sleep(backoff(delay, i))
+    else:
+        failures.append(["Role {0} failed after {1} retries\n".format(
+            role, retries)])
+
+    if role.get("bundle") and os.path.isdir(role["dest"]):
+        try:
+            git.Repo(role["dest"]).remote().set_url(role["src"])
+        except Exception as e:
+            failures.append("Failed to restore the remote of %s\n%s" %
+                            (role["dest"], str(e)))
+            result["action"] = None
+
+    result["finished"] = time.time()
+    result["elapsed"] = result["finished"] - result["started"]
+    result["bytes"] = max(objects_size(role["dest"]) - size, 0)
+    try:
+        result["commit"] = head_commit(git.Repo(role["dest"]))
+    except Exception:
+        pass
+    return result, failures
+
+
+def plan_role(info):
+    role, config = info
+    entry = {
+        "name": role["name"],
+        "dest": role["dest"],
+        "version": role["version"],
+        "commit": role.get("commit"),
+        "current": None,
+        "set_url": False
+    }
+    if not os.path.exists(role["dest"]):
+        entry["action"] = "clone"
+        return entry
+    try:
+        repo = git.Repo(role["dest"])
+        entry["set_url"] = list(repo.remote().urls)[0] != role["src"]
+    except Exception:
+        entry["action"] = "broken"
+        return entry
+
+    entry["current"] = head_commit(repo)
+    sparse_changed = sparse_paths_changed(repo, role["sparse_paths"])
+    dirty = config["force"] and repo.is_dirty(untracked_files=True)
+
+    if sparse_changed or dirty:
+        entry["action"] = "checkout"
+    elif entry["commit"]:
+        if entry["commit"] == entry["current"]:
+            entry["action"] = "noop"
         else:
-            time.sleep(delay)
-    info[2].append(["Role {0} failed after {1} retries\n".format(role_info[0],
-                                                                 retries)])
-    return False
+            entry["action"] = "checkout"
+    else:
+        # Without a resolved commit the real run describes tags before
+        # deciding to fetch, so do the same here.
+        try:
+            current_version = repo.git.describe(tags=True)
+        except Exception:
+            current_version = ""
+        if (role["version"] != "master" and
+                current_version == role["version"] and not config["force"]):
+            entry["action"] = "noop"
+        else:
+            entry["action"] = "fetch"
+    return entry
+
+
+def summarise(results, elapsed, workers):
+    # Sweep over start and finish events to find the peak concurrency
+    events = sorted([(r["started"], 1) for r in results] +
+                    [(r["finished"], -1) for r in results])
+    running = concurrency = 0
+    for _, step in events:
+        running += step
+        concurrency = max(concurrency, running)
+    busy = sum(r["elapsed"] for r in results)
+    slowest = sorted(results, key=lambda r: r["elapsed"], reverse=True)
+    return {
+        "repos": len(results),
+        "workers": workers,
+        "elapsed": elapsed,
+        "bytes": sum(r["bytes"] for r in results),
+        "concurrency_peak": concurrency,
+        "concurrency_mean": busy / elapsed if elapsed else 0.0,
+        "actions": dict(collections.Counter(r["action"] for r in results)),
+        "slowest": [
+            {"name": r["name"], "action": r["action"], "elapsed": r["elapsed"]}
+            for r in slowest[:5]
+        ]
+    }
 
 
 def pull_role(info):
@@ -190,15 +669,53 @@ def pull_role(info):
             failures.append(failtxt)
             return False
 
+    current_commit = None
+    sparse_changed = False
+    seeded = False
+    # Another destination of the same src seeds this one with hardlinked
+    # objects, so only what it lacks is fetched from the remote.
+    # A seed left shallow by an earlier run is not used either.
+    if (role.get("seed") and os.path.isdir(role["seed"]) and
+            not os.path.exists(os.path.join(role["seed"], ".git",
+                                            "shallow")) and
+            not os.path.exists(role["dest"])):
+        try:
+            git.Repo.clone_from(role["seed"], role["dest"], local=True)
+            seeded = True
+        except Exception as e:
+            shutil.rmtree(role["dest"], ignore_errors=True)
+            failures.append("Failed to seed %s from %s\n%s" %
+                            (role["dest"], role["seed"], str(e)))
+            return False, None
+
     # if repo exists
     if os.path.exists(role["dest"]):
         repo = get_repo(role["dest"])
         if not repo:
-            return False  # go to next role
+            return False, None  # go to next role
         repo_url = list(repo.remote().urls)[0]
         if repo_url != role["src"]:
             repo.remote().set_url(role["src"])
+        if role.get("reference"):
+            add_reference(repo, role["reference"])
+        # Runs without sparse paths too, so that a repo which no longer
+        # asks for any gets its full working tree back.
+        try:
+            sparse_changed = set_sparse_paths(repo, role["sparse_paths"])
+        except Exception as e:
+            failures.append("Failed to set sparse paths for %s\n%s" %
+                            (role["dest"], str(e)))
+            return False, None
+
+        # Nothing to fetch or check out when HEAD already is the commit the
+        # remote resolved the version to. A seeded repo counts as a clone.
+        if not seeded:
+            current_commit = head_commit(repo)
+        if role.get("commit") and role["commit"] == current_commit:
+            if not (config["force"] and repo.is_dirty(untracked_files=True)):
+                return True, "checkout" if sparse_changed else "noop"
 
+        action = "fetch"
         # if they want master then fetch, checkout and pull to stay at latest
         # master
         if required_version == "master":
@@ -206,7 +723,8 @@ def pull_role(info):
                                      force=config["force"],
                                      refspec=role["refspec"],
                                      depth=role["depth"],
-                                     shallow_since=role["shallow_since"])
+                                     shallow_since=role["shallow_since"],
+                                     filter=role["filter"])
 
         # If we have a hash then reset it to
         elif version_hash:
@@ -214,7 +732,8 @@ def pull_role(info):
                                      force=config["force"],
                                      refspec=role["refspec"],
                                      depth=role["depth"],
-                                     shallow_since=role["shallow_since"])
+                                     shallow_since=role["shallow_since"],
+                                     filter=role["filter"])
         else:
             # describe can fail in some cases so be careful:
             try:
@@ -223,13 +742,14 @@ def pull_role(info):
                 current_version = ""
             if current_version == required_version and not config["force"]:
                 fail = []
-                pass
+                action = "noop"
             else:
                 fail = check_out_version(repo, required_version,
                                          force=config["force"],
                                          refspec=role["refspec"],
                                          depth=role["depth"],
                                          shallow_since=role["shallow_since"],
+                                         filter=role["filter"],
                                          tag=True)
 
     else:
@@ -245,9 +765,14 @@ def pull_role(info):
                 repo = git.Repo.clone_from(role["src"], role["dest"],
                                            no_single_branch=True,
                                            depth=depth,
-                                           shallow_since=shallow_since,)
+                                           shallow_since=shallow_since,
+                                           reference=role.get("reference"),
+                                           filter=role["filter"],
+                                           sparse=bool(role["sparse_paths"]))
                 if not repo:
-                    return False  # go to next role
+                    return False, None  # go to next role
+                if role["sparse_paths"]:
+                    set_sparse_paths(repo, role["sparse_paths"])
                 fail = check_out_version(repo, required_version,
                                          force=config["force"],
                                          refspec=role["refspec"],
@@ -255,21 +780,31 @@ def pull_role(info):
                                          fetch=False,
                                          shallow_since=shallow_since,)
             else:
-                git.Repo.clone_from(role["src"], role["dest"],
-                                    branch=required_version,
-                                    depth=depth,
-                                    shallow_since=shallow_since,
-                                    no_single_branch=True)
+                repo = git.Repo.clone_from(role["src"], role["dest"],
+                                           branch=required_version,
+                                           depth=depth,
+                                           shallow_since=shallow_since,
+                                           no_single_branch=True,
+                                           reference=role.get("reference"),
+                                           filter=role["filter"],
+                                           sparse=bool(role["sparse_paths"]))
+                if role["sparse_paths"]:
+                    set_sparse_paths(repo, role["sparse_paths"])
                 fail = []
 
         except Exception as e:
             fail = ('Failed cloning repo %s\n%s' % (role["dest"], str(e)))
 
     if fail == []:
-        return True
+        # Fresh clones have no previous commit and are always a change
+        if current_commit is None:
+            return True, "clone"
+        if sparse_changed or head_commit(repo) != current_commit:
+            return True, "checkout"
+        return True, action
     else:
         failures.append(fail)
-        return False
+        return False, None
 
 
 def set_default(dictionary, key, defaults):
@@ -294,6 +829,9 @@ def main():
         "default_depth": {"required": False,
                           "type": "int",
                           "default": None},
+        "default_filter": {"required": False,
+                           "type": "str",
+                           "default": None},
         "default_shallow_since": {"required": False,
                                   "type": str,
                                   "default": None},
@@ -312,10 +850,22 @@ def main():
         "core_maximum": {"required": False,
                           "type": "int",
                           "default": 16},
+        "bundle_path": {"required": False,
+                        "type": "path",
+                        "default": None},
+        "bundle_create": {"required": False,
+                          "type": "path",
+                          "default": None},
+        "host_maximum": {"required": False,
+                         "type": "int",
+                         "default": None},
+        "reference_cache": {"required": False,
+                            "type": "path",
+                            "default": None},
     }
 
     # Pull in module fields and pass into variables
-    module = AnsibleModule(argument_spec=fields)
+    module = AnsibleModule(argument_spec=fields, supports_check_mode=True)
 
     git_repos = module.params['repo_info']
     defaults = {
@@ -323,7 +873,9 @@ def main():
         "depth": module.params["default_depth"],
         "shallow_since": module.params["default_shallow_since"],
         "version": module.params["default_version"],
-        "refspec": module.params["default_refspec"]
+        "refspec": module.params["default_refspec"],
+        "filter": module.params["default_filter"],
+        "sparse_paths": None
     }
     config = {
         "retries": module.params["retries"],
@@ -335,40 +887,149 @@ def main():
 
     # Set up defaults
     for repo in git_repos:
-        for key in ["path", "refspec", "version", "depth", "shallow_since"]:
+        for key in ["path", "refspec", "version", "depth", "shallow_since",
+                    "filter", "sparse_paths"]:
             set_default(repo, key, defaults)
         if "name" not in repo.keys():
             repo["name"] = os.path.basename(repo["src"])
         repo["dest"] = os.path.join(repo["path"], repo["name"])
 
     # Define varibles
-    failures = multiprocessing.Manager().list()
-    core_count = multiprocessing.cpu_count() * config["core_multiplier"]
+    core_count = (os.cpu_count() or 1) * config["core_multiplier"]
     core_count = min(core_count, config["core_maximum"])
 
-    # Load up process and pass in interrupt and core process count
-    p = multiprocessing.Pool(core_count, init_signal)
+    # The work is bound by network and git subprocesses, so threads are
+    # enough, and the limiter backs off from a git server that fails.
+    executor = futures.ThreadPoolExecutor(max_workers=core_count)
+    limiter = HostLimiter(module.params["host_maximum"] or core_count)
+
+    started = time.time()
+    phases = {}
+
+    # Repos found in the bundles are synced from local files only
+    bundle_path = module.params["bundle_path"]
+    bundle_dir = None
+    if bundle_path:
+        if os.path.isfile(bundle_path):
+            bundle_dir = bundle_path = extract_bundles(bundle_path)
+        for repo in git_repos:
+            bundle = os.path.join(bundle_path, "%s.bundle" % repo["name"])
+            if os.path.isfile(bundle):
+                repo["bundle"] = bundle
+
+    # Refresh one mirror per unique src before cloning from any of them
+    reference_cache = module.params["reference_cache"]
+    remotes = dict((repo["src"], repo["src"]) for repo in git_repos
+                   if len(repo["version"]) != 40 and not repo.get("bundle"))
+    if reference_cache and not module.check_mode:
+        if not os.path.isdir(reference_cache):
+            os.makedirs(reference_cache)
+        mirrors = {}
+        for repo in git_repos:
+            mirrors[repo["src"]] = mirror_path(reference_cache, repo["src"])
+        # Existing mirrors are still used as a reference for bundled repos,
+        # but they are only refreshed for repos that go to the network.
+        online = [src for src in mirrors
+                  if any(repo["src"] == src and not repo.get("bundle")
+                         for repo in git_repos)]
+        warnings = executor.map(update_mirror,
+                                [(src, mirrors[src], limiter)
+                                 for src in online])
+        for src, warning in zip(online, warnings):
+            if warning:
+                module.warn(warning)
+            elif src in remotes:
+                # A freshly fetched mirror answers ls-remote locally
+                remotes[src] = mirrors[src]
+        # A stale mirror still saves most of the transfer, a missing one
+        # simply means cloning straight from the remote.
+        for repo in git_repos:
+            if os.path.isdir(mirrors[repo["src"]]):
+                repo["reference"] = mirrors[repo["src"]]
+        phases["mirror"] = time.time() - started
 
-    clone_success = p.map(pull_wrapper, zip(git_repos,
-                                            itertools.repeat(config),
-                                            itertools.repeat(failures)),
-                          chunksize=1)
-    p.close()
+    # Resolve every requested version with one ls-remote per unique src so
+    # that repos already at the right commit are not touched at all.
+    resolve_started = time.time()
+    refs = dict(executor.map(list_remote,
+                             [(src, url, limiter)
+                              for src, url in remotes.items()]))
+    refs.update(executor.map(list_remote,
+                             [(repo["name"], repo["bundle"], limiter)
+                              for repo in git_repos if repo.get("bundle")]))
+    for repo in git_repos:
+        if repo.get("bundle"):
+            repo["commit"] = resolve_version(repo["version"],
+                                             refs.get(repo["name"]))
+            continue
+        if repo["refspec"] and len(repo["version"]) != 40:
+            continue
+        repo["commit"] = resolve_version(repo["version"],
+                                         refs.get(repo["src"]))
+    phases["resolve"] = time.time() - resolve_started
+
+    # Check mode only inspects the destinations, nothing is written
+    if module.check_mode:
+        entries = list(executor.map(plan_role,
+                                    zip(git_repos, itertools.repeat(config))))
+        executor.shutdown()
+        if bundle_dir:
+            shutil.rmtree(bundle_dir, ignore_errors=True)
+        plan = [entry for entry in entries if entry["action"] != "noop"]
+        module.exit_json(msg=str(git_repos), changed=bool(plan), plan=plan)
+
+    # Repos sharing a src are seeded from the first destination of that
+    # src, after it has been synced. Partial clones are not used as seeds
+    # since a local clone does not inherit their promisor remote, and
+    # shallow ones are not either since the seeded clone would inherit the
+    # history of the seed rather than the one it asks for.
+    primaries = {}
+    for repo in git_repos:
+        primary = primaries.setdefault(repo["src"], repo)
+        if primary is repo or primary["dest"] == repo["dest"]:
+            continue
+        if primary["filter"] or repo["filter"] or repo.get("bundle"):
+            continue
+        if any(entry[key] for entry in (primary, repo)
+               for key in ("depth", "shallow_since")):
+            continue
+        repo["seed"] = primary["dest"]
 
-    success = all(i for i in clone_success)
+    sync_started = time.time()
+    clone_success = [None] * len(git_repos)
+    for wave in (False, True):
+        indexes = [i for i, repo in enumerate(git_repos)
+                   if bool(repo.get("seed")) == wave]
+        results = executor.map(pull_wrapper,
+                               [(git_repos[i], config, limiter)
+                                for i in indexes])
+        for i, result in zip(indexes, results):
+            clone_success[i] = result
+    phases["sync"] = time.time() - sync_started
+    if bundle_dir:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+    results = [result for result, _ in clone_success]
+    if module.params["bundle_create"] and all(r["action"] for r in results):
+        bundle_started = time.time()
+        for warning in write_bundles(git_repos, executor,
+                                     module.params["bundle_create"]):
+            module.warn(warning)
+        phases["bundle"] = time.time() - bundle_started
+    executor.shutdown()
+    stats = summarise(results, time.time() - started, core_count)
+    stats["phases"] = phases
+
+    success = all(result["action"] for result in results)
     if success:
-        module.exit_json(msg=str(git_repos), changed=True)
+        changed = any(result["changed"] for result in results)
+        module.exit_json(msg=str(git_repos), changed=changed, repos=results,
+                         stats=stats)
     else:
-        # Deep convert ListProxy and any nested ListProxies to standard lists
-        # to avoid TypeError during Ansible serialization.
-        cleaned_failures = []
-        for f in failures:
-            # Check for list-like objects (including ListProxy) that aren't strings
-            if hasattr(f, '__iter__') and not isinstance(f, (str, bytes)):
-                cleaned_failures.append(list(f))
-            else:
-                cleaned_failures.append(f)
-        module.fail_json(msg="Module failed", meta=cleaned_failures)
+        failures = list(itertools.chain.from_iterable(
+            i for _, i in clone_success))
+        module.fail_json(msg="Module failed", meta=failures, repos=results,
+                         stats=stats)
 
 
 if __name__ == '__main__':
@@ -17,6 +17,14 @@
 
 # Based on Jimmy Tang's implementation
 
+from concurrent import futures
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
 DOCUMENTATION = """
 ---
 module: keystone
@@ -215,6 +223,7 @@ options:
     command:
         description:
             - Indicate desired state of the resource
+            - Either C(command) or C(batch) must be given.
         choices: ['get_tenant', 'get_project', 'get_user', 'get_role',
                   'ensure_service', 'ensure_endpoint', 'ensure_role',
                   'ensure_user', 'ensure_user_role', 'ensure_tenant',
@@ -222,7 +231,31 @@ options:
                   'ensure_group', 'ensure_identity_provider',
                   'ensure_protocol', ensure_mapping',
                   'ensure_group_role']
-        required: true
+        required: false
+    batch:
+        description:
+            - List of operations to run with a single authenticated session.
+            - Every item is a dict holding a C(command) and the options of
+              that command, eg C(user_name) or C(endpoint_list). Options
+              that an item does not set are taken from the task.
+            - Login options can not be set per item.
+            - Items run in stages, domains first, then projects, roles,
+              groups, services and federation resources, then users,
+              endpoints and protocols, then role assignments, and the get
+              commands last. Items of one stage run concurrently, except
+              for items that manage the same resource, which run in the
+              order given.
+            - The result of every item is returned in C(results), and the
+              task is changed when any of the items changed.
+        required: false
+        default: None
+        type: list
+    batch_workers:
+        description:
+            - Number of batch items run concurrently.
+            - With 1 the items run one after the other in the order given.
+        required: false
+        default: 4
     insecure:
         description:
             - Explicitly allow client to perform "insecure" TLS
@@ -230,6 +263,31 @@ options:
             - false
             - true
         default: false
+    token_cache:
+        description:
+            - Directory in which the token issued for the login credentials is
+              kept, so that later tasks using the same endpoint, credentials,
+              project and domains reuse it instead of requesting a new one.
+            - Tokens are only reused when they are valid for at least
+              C(token_cache_margin) more seconds. The directory is created
+              with mode 0700 and every token file with mode 0600, files that
+              are not owned by the user running the module or are readable by
+              others are ignored.
+            - The token cache is not used when C(token) is given.
+        required: false
+        default: None
+    token_cache_margin:
+        description:
+            - Minimum number of seconds a cached token must still be valid
+              for to be reused.
+        required: false
+        default: 300
+notes:
+    - In check mode nothing is written to Keystone. Every create, update,
+      delete and role assignment that would have been made is returned in
+      C(plan), and in the C(plan) of every batch item. Resources that would
+      have been created are visible to the later items of a batch, with an
+      id starting with C(planned-).
 requirements: [ python-keystoneclient ]
 author: Kevin Carter
 """
@@ -320,25 +378,67 @@ EXAMPLES = """
     command: "get_role"
     user_name: "admin"
 
+# Preview the changes of a batch, and only apply them when needed
+- keystone:
+    batch: "{{ keystone_batch }}"
+  check_mode: true
+  register: keystone_plan
+
+- keystone:
+    batch: "{{ keystone_batch }}"
+  when: keystone_plan is changed
+
+# Create a service, its endpoints and its user in one task
+- keystone:
+    project_name: "service"
+    batch:
+      - command: "ensure_service"
+        service_name: "glance"
+        service_type: "image"
+        description: "Glance Image Service"
+      - command: "ensure_endpoint"
+        region_name: "RegionOne"
+        service_name: "glance"
+        service_type: "image"
+        endpoint_list:
+          - url: "http://127.0.0.1:9292"
+            interface: "public"
+      - command: "ensure_user"
+        user_name: "glance"
+        password: "secrete"
+      - command: "ensure_user_role"
+        user_name: "glance"
+        role_name: "admin"
+
 """
 
+# Every command lists the module options it uses in 'variables'. Items of a
+# batch run in the order of their 'stage', and items of the same stage whose
+# 'key' options are equal run one after the other in the order given. A
+# command without key options only depends on earlier stages.
 COMMAND_MAP = {
     'get_tenant': {
         'variables': [
             'project_name',
             'tenant_name'
-        ]
+        ],
+        'stage': 4,
+        'key': []
     },
     'get_project': {
         'variables': [
             'project_name',
             'tenant_name'
-        ]
+        ],
+        'stage': 4,
+        'key': []
     },
     'get_user': {
         'variables': [
             'user_name'
-        ]
+        ],
+        'stage': 4,
+        'key': []
     },
     'get_role': {
         'variables': [
@@ -346,13 +446,20 @@ COMMAND_MAP = {
             'project_name',
             'tenant_name',
             'user_name'
-        ]
+        ],
+        'stage': 4,
+        'key': []
     },
     'ensure_service': {
         'variables': [
             'service_name',
             'service_type',
             'description'
+        ],
+        'stage': 1,
+        'key': [
+            'service_name',
+            'service_type'
         ]
     },
     'ensure_endpoint': {
@@ -362,11 +469,21 @@ COMMAND_MAP = {
             'service_type',
             'endpoint_list',
             'state'
+        ],
+        'stage': 2,
+        'key': [
+            'region_name',
+            'service_name',
+            'service_type'
         ]
     },
     'ensure_role': {
         'variables': [
             'role_name'
+        ],
+        'stage': 1,
+        'key': [
+            'role_name'
         ]
     },
     'ensure_user': {
@@ -377,6 +494,11 @@ COMMAND_MAP = {
             'password',
             'email',
             'domain_name'
+        ],
+        'stage': 2,
+        'key': [
+            'user_name',
+            'domain_name'
         ]
     },
     'ensure_user_role': {
@@ -386,6 +508,14 @@ COMMAND_MAP = {
             'tenant_name',
             'role_name',
             'domain_name'
+        ],
+        'stage': 3,
+        'key': [
+            'user_name',
+            'project_name',
+            'tenant_name',
+            'role_name',
+            'domain_name'
         ]
     },
     'ensure_group_role': {
@@ -394,6 +524,13 @@ COMMAND_MAP = {
             'project_name',
             'role_name',
             'domain_name'
+        ],
+        'stage': 3,
+        'key': [
+            'group_name',
+            'project_name',
+            'role_name',
+            'domain_name'
         ]
     },
     'ensure_project': {
@@ -402,6 +539,12 @@ COMMAND_MAP = {
             'tenant_name',
             'description',
             'domain_name'
+        ],
+        'stage': 1,
+        'key': [
+            'project_name',
+            'tenant_name',
+            'domain_name'
         ]
     },
     'ensure_tenant': {
@@ -410,12 +553,23 @@ COMMAND_MAP = {
             'tenant_name',
             'description',
             'domain_name'
+        ],
+        'stage': 1,
+        'key': [
+            'project_name',
+            'tenant_name',
+            'domain_name'
         ]
     },
     'ensure_group': {
         'variables': [
             'group_name',
             'domain_name'
+        ],
+        'stage': 1,
+        'key': [
+            'group_name',
+            'domain_name'
         ]
     },
     'ensure_identity_provider': {
@@ -424,6 +578,10 @@ COMMAND_MAP = {
             'idp_remote_ids',
             'idp_enabled',
             'idp_domain_id'
+        ],
+        'stage': 1,
+        'key': [
+            'idp_name'
         ]
     },
     'ensure_service_provider': {
@@ -432,6 +590,10 @@ COMMAND_MAP = {
             'sp_url',
             'sp_auth_url',
             'sp_enabled'
+        ],
+        'stage': 1,
+        'key': [
+            'sp_name'
         ]
     },
     'ensure_protocol': {
@@ -439,18 +601,31 @@ COMMAND_MAP = {
             'protocol_name',
             'idp_name',
             'mapping_name'
+        ],
+        'stage': 2,
+        'key': [
+            'protocol_name',
+            'idp_name'
         ]
     },
     'ensure_mapping': {
         'variables': [
             'mapping_name',
             'mapping_rules',
+        ],
+        'stage': 1,
+        'key': [
+            'mapping_name'
         ]
     },
     'ensure_domain': {
         'variables': [
             'domain_name',
             'domain_enabled'
+        ],
+        'stage': 0,
+        'key': [
+            'domain_name'
         ]
     }
 }
@@ -460,6 +635,7 @@ try:
     from keystoneclient import client
     from keystoneauth1.identity import v3
     from keystoneauth1 import session
+    import requests
 
 except ImportError:
     keystoneclient_found = False
@@ -467,18 +643,287 @@ else:
     keystoneclient_found = True
 
 
+class Snapshot(object):
+    """Entries of a keystone collection indexed by their lookup keys.
+
+    Batch workers read a snapshot without a lock while another worker may
+    update it, so updates build a new list and index and swap them in with a
+    single assignment, readers never see a partly built index.
+    """
+
+    def __init__(self, keys, entries=()):
+        """Index a listing of a collection.
+
+        :param keys: ``callable``  Return the list of index keys of an entry.
+        :param entries: ``list``  Entries returned by the list call.
+        """
+        self.keys = keys
+        self.state = self._index(list(entries))
+
+    def _index(self, entries):
+        """Return the (entries, index) pair, earlier entries win."""
+        index = {}
+        for entry in entries:
+            for key in self.keys(entry):
+                index.setdefault(key, entry)
+        return entries, index
+
+    @property
+    def entries(self):
+        return self.state[0]
+
+    def add(self, entry):
+        """Add a new entry, earlier entries win on duplicate keys."""
+        self.state = self._index(self.entries + [entry])
+
+    def remove(self, entry):
+        """Remove an entry and re-index the remaining ones."""
+        self.state = self._index(
+            [e for e in self.entries if e.id != entry.id]
+        )
+
+    def replace(self, old, new):
+        """Replace an entry by its updated version."""
+        self.state = self._index(
+            [e for e in self.entries if e.id != old.id] + [new]
+        )
+
+    def get(self, key):
+        return self.state[1].get(key)
+
+
+class Planned(object):
+    """Stand-in for a resource that check mode did not write."""
+
+    def __init__(self, resource, **attributes):
+        self.id = 'planned-%s-%s' % (resource, attributes.get('name'))
+        self.__dict__.update(attributes)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class CommandFailure(Exception):
+    """A batch item failed, raised to stop the thread running it."""
+
+    def __init__(self, item, error, rc, msg):
+        super(CommandFailure, self).__init__(msg)
+        self.item = item
+        self.error = error
+        self.rc = rc
+        self.msg = msg
+
+
 class ManageKeystone(object):
     def __init__(self, module):
         """Manage Keystone via Ansible."""
+        # Batch items run in worker threads, so the state of the command
+        # being run is kept per thread.
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.key_locks = {}
         self.state_change = False
         self.keystone = None
+        self.auth = None
+        self.token_cache_file = None
+        self.cache = {}
+        self.snapshots = {}
+        self.results = []
 
         # Load AnsibleModule
         self.module = module
 
+    @property
+    def params(self):
+        """Return the parameters of the command being run.
+
+        These are the module parameters, updated with the options of the
+        batch item run by the current thread.
+        """
+        return getattr(self.local, 'params', self.module.params)
+
+    @params.setter
+    def params(self, value):
+        self.local.params = value
+
+    @property
+    def state_change(self):
+        return getattr(self.local, 'state_change', False)
+
+    @state_change.setter
+    def state_change(self, value):
+        self.local.state_change = value
+
+    @property
+    def plan(self):
+        """Return the changes check mode skipped in the current command."""
+        if not hasattr(self.local, 'plan'):
+            self.local.plan = []
+        return self.local.plan
+
+    @plan.setter
+    def plan(self, value):
+        self.local.plan = value
+
+    def _plan(self, action, resource, name, **details):
+        """Record a change that check mode does not make.
+
+        :param action: ``str``  One of create, update or delete.
+        :param resource: ``str``  Type of the resource, eg project.
+        :param name: ``str``  Name of the resource.
+        :param details: Other attributes worth reporting.
+        """
+        self.state_change = True
+        change = {'action': action, 'resource': resource, 'name': name}
+        change.update(details)
+        self.plan.append(change)
+
     def command_router(self):
         """Run the command as its provided to the module."""
-        command_name = self.module.params['command']
+        if self.module.params.get('batch') is not None:
+            return self.batch_router()
+
+        facts = self._run_command(self.module.params['command'])
+        self._save_token()
+        result = {'changed': self.state_change}
+        if self.module.check_mode:
+            result['plan'] = self.plan
+        if facts is not None:
+            result['ansible_facts'] = facts
+        self.module.exit_json(**result)
+
+    def batch_router(self):
+        """Run every operation of the batch with one keystone client."""
+        items = self.module.params['batch']
+        item_vars = set(['command'])
+        for command in COMMAND_MAP.values():
+            item_vars.update(command['variables'])
+
+        for item in items:
+            if not isinstance(item, dict) or 'command' not in item:
+                self.failure(
+                    error='Invalid batch item',
+                    rc=2,
+                    msg='Every batch item must be a dict with a command,'
+                        ' got [ %s ]' % item
+                )
+            if item['command'] not in COMMAND_MAP:
+                self.failure(
+                    error='No Command Found',
+                    rc=2,
+                    msg='Command [ %s ] was not found.' % item['command']
+                )
+            unknown = sorted(set(item) - item_vars)
+            if unknown:
+                self.failure(
+                    error='Invalid batch item options %s' % unknown,
+                    rc=2,
+                    msg='Options %s can not be used in a batch item.'
+                        % unknown
+                )
+
+        self._authenticate()
+        self.results = [None] * len(items)
+        workers = max(int(self.module.params['batch_workers']), 1)
+        failures = []
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for stage in self._batch_stages(items, workers):
+                jobs = [executor.submit(self._run_items, group)
+                        for group in stage]
+                for job in jobs:
+                    try:
+                        job.result()
+                    except CommandFailure as e:
+                        failures.append(e)
+                if failures:
+                    break
+
+        results = [r for r in self.results if r is not None]
+        summary = {
+            'changed': any(r['changed'] for r in results),
+            'results': results
+        }
+        if self.module.check_mode:
+            summary['plan'] = [change for r in results
+                               for change in r['plan']]
+        self._save_token()
+        if failures:
+            failure = min(failures, key=lambda e: e.item)
+            self.module.fail_json(msg=failure.msg, rc=failure.rc,
+                                  err=failure.error,
+                                  failed_item=failure.item, **summary)
+        self.module.exit_json(**summary)
+
+    def _batch_stages(self, items, workers):
+        """Return the batch as a list of stages of groups of items.
+
+        The groups of a stage can run concurrently, the items of a group run
+        one after the other. With a single worker the whole batch is one
+        group so the items run in the order given.
+
+        :param items: ``list``  Items of the batch.
+        :param workers: ``int``  Number of items run concurrently.
+        """
+        if workers == 1:
+            return [[list(enumerate(items))]]
+
+        stages = {}
+        for index, item in enumerate(items):
+            command = COMMAND_MAP[item['command']]
+            params = dict(self.module.params)
+            params.update(item)
+            # Commands fall back to the default domain the same way
+            # _get_domain_from_vars does, so the key has to as well.
+            params['domain_name'] = params.get('domain_name') or 'Default'
+            if command['key']:
+                key = (tuple(command['key']),) + tuple(
+                    params.get(var) for var in command['key']
+                )
+            else:
+                key = index
+            groups = stages.setdefault(command['stage'],
+                                       collections.OrderedDict())
+            groups.setdefault(key, []).append((index, item))
+        return [list(stages[stage].values()) for stage in sorted(stages)]
+
+    def _run_items(self, items):
+        """Run batch items one after the other, in the calling thread.
+
+        :param items: ``list``  Pairs of the index and the batch item.
+        """
+        for index, item in items:
+            self.local.item = index
+            self.params = dict(self.module.params)
+            self.params.update(item)
+            self.state_change = False
+            self.plan = []
+            try:
+                facts = self._run_command(item['command'])
+            except CommandFailure:
+                raise
+            except Exception as e:
+                # Anything else escaping a worker would lose the results of
+                # the whole batch, report it as a failure of this item.
+                self.failure(
+                    error=str(e),
+                    rc=2,
+                    msg='Command [ %s ] failed: %s: %s'
+                        % (item['command'], type(e).__name__, e)
+                )
+            self.results[index] = {
+                'item': index,
+                'command': item['command'],
+                'changed': self.state_change,
+                'keystone_facts': (facts or {}).get('keystone_facts', {})
+            }
+            if self.module.check_mode:
+                self.results[index]['plan'] = self.plan
+
+    def _run_command(self, command_name):
+        """Run a single command and return its facts.
+
+        :param command_name: ``str``  Name of the command to run.
+        """
         if command_name not in COMMAND_MAP:
             self.failure(
                 error='No Command Found',
@@ -489,14 +934,7 @@ class ManageKeystone(object):
         action_command = COMMAND_MAP[command_name]
         if hasattr(self, '%s' % command_name):
             action = getattr(self, '%s' % command_name)
-            facts = action(variables=action_command['variables'])
-            if facts is None:
-                self.module.exit_json(changed=self.state_change)
-            else:
-                self.module.exit_json(
-                    changed=self.state_change,
-                    ansible_facts=facts
-                )
+            return action(variables=list(action_command['variables']))
         else:
             self.failure(
                 error='Command not in ManageKeystone class',
@@ -504,6 +942,22 @@ class ManageKeystone(object):
                 msg='Method [ %s ] was not found.' % command_name
             )
 
+    def _cached(self, key, lookup):
+        """Return the result of a lookup, reusing earlier results.
+
+        Only entries that were found are kept, so a lookup for something
+        that does not exist yet is retried after it has been created.
+
+        :param key: ``tuple``  Kind and identifying values of the lookup.
+        :param lookup: ``callable``  Return the entry or None.
+        """
+        if key not in self.cache:
+            entry = lookup()
+            if entry is None:
+                return None
+            self.cache[key] = entry
+        return self.cache[key]
+
     @staticmethod
     def _facts(facts):
         """Return a dict for our Ansible facts.
@@ -521,7 +975,7 @@ class ManageKeystone(object):
         """
         return_dict = {}
         for variable in variables:
-            return_dict[variable] = self.module.params.get(variable)
+            return_dict[variable] = self.params.get(variable)
         else:
             if isinstance(required, list):
                 for var_name in required:
@@ -532,7 +986,7 @@ class ManageKeystone(object):
                                   ' value' % var_name,
                             rc=000,
                             msg='variables %s - available params [ %s ]'
-                                % (variables, self.module.params)
+                                % (variables, self.params)
                         )
             return return_dict
 
@@ -543,10 +997,19 @@ class ManageKeystone(object):
         :param rc: ``int``     Return code while executing an Ansible command.
         :param msg: ``str``    Message to report.
         """
+        item = getattr(self.local, 'item', None)
+        if item is not None:
+            # fail_json can not be called from a worker thread, the batch
+            # reports the failure along with the items that already ran.
+            raise CommandFailure(item=item, error=error, rc=rc, msg=msg)
         self.module.fail_json(msg=msg, rc=rc, err=error)
 
     def _authenticate(self):
         """Return a keystone client object."""
+        if self.keystone is not None:
+            # Batch items share the client built for the first command.
+            return
+
         required_vars = ['endpoint']
         variables = [
             'endpoint',
@@ -613,11 +1076,181 @@ class ManageKeystone(object):
 
             if variables_dict.pop('ignore_catalog'):
                 client_args.update(endpoint_override=endpoint)
-            auth = v3.Password(**auth_args)
-            sess = session.Session(auth=auth, verify=(not insecure))
+            self.auth = v3.Password(**auth_args)
+            self._load_token(auth_args)
+            sess = session.Session(auth=self.auth, verify=(not insecure),
+                                   session=self._http_session())
             self.keystone = client.Client(session=sess,
                                           **client_args)
 
+    def _http_session(self):
+        """Return a requests session with a connection per batch worker."""
+        http = requests.Session()
+        if self.module.params.get('batch') is not None:
+            workers = max(int(self.module.params['batch_workers']), 1)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+            http.mount('http://', adapter)
+            http.mount('https://', adapter)
+        return http
+
+    def _load_token(self, auth_args):
+        """Install a cached token into the password auth plugin.
+
+        The cache file is named after a hash of all the authentication
+        arguments, password included, so a token is only ever handed to a
+        task that could have requested it itself.
+
+        :param auth_args: ``dict``  Arguments of the password auth plugin.
+        """
+        token_cache = self.module.params.get('token_cache')
+        if not token_cache:
+            return
+
+        key = hashlib.sha256(
+            json.dumps(auth_args, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        self.token_cache_file = os.path.join(
+            os.path.expanduser(token_cache), '%s.json' % key
+        )
+        try:
+            stat = os.stat(self.token_cache_file)
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                self.module.warn('Ignoring token cache file %s, it must be'
+                                 ' owned by the current user and have mode'
+                                 ' 0600' % self.token_cache_file)
+                return
+            with open(self.token_cache_file) as f:
+                self.auth.set_auth_state(f.read())
+        except (IOError, OSError, KeyError, ValueError):
+            self.auth.set_auth_state(None)
+            return
+
+        margin = int(self.module.params.get('token_cache_margin'))
+        if self.auth.auth_ref.will_expire_soon(margin):
+            self.auth.set_auth_state(None)
+
+    def _save_token(self):
+        """Write the token of the password auth plugin to the cache."""
+        if self.token_cache_file is None:
+            return
+
+        state = self.auth.get_auth_state()
+        if state is None:
+            return
+
+        directory = os.path.dirname(self.token_cache_file)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            # mkstemp creates the file with mode 0600
+            fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(state)
+            os.rename(path, self.token_cache_file)
+        except (IOError, OSError) as e:
+            self.module.warn('Unable to write the token cache file %s: %s'
+                             % (self.token_cache_file, e))
+
+    @staticmethod
+    def _list(manager, filters, **kwargs):
+        """Return the entries of a collection, filtered by the server.
+
+        The ``filters`` are sent to Keystone as query parameters so only the
+        matching entries are returned. Callers still have to check the
+        entries because Keystone silently ignores filters it does not know
+        about. If the server rejects the filtered query the collection is
+        listed with ``kwargs`` alone instead.
+
+        :param manager: keystoneclient manager, eg self.keystone.projects
+        :param filters: ``dict``  Query parameters used to narrow the list.
+        :param kwargs: Arguments always passed to the list call.
+        """
+        if any(isinstance(v, Planned) for v in kwargs.values()):
+            # Nothing exists yet within a resource check mode did not create
+            return []
+
+        query = dict(kwargs)
+        query.update(filters)
+        try:
+            return manager.list(**query)
+        except (kexceptions.BadRequest, kexceptions.HttpNotImplemented):
+            return manager.list(**kwargs)
+
+    def _find(self, manager, match, filters, **kwargs):
+        """Return the first entry of a collection that satisfies ``match``.
+
+        :param manager: keystoneclient manager, eg self.keystone.projects
+        :param match: ``callable``  Return True for the wanted entry.
+        :param filters: ``dict``  Query parameters used to narrow the list.
+        :param kwargs: Arguments always passed to the list call.
+        """
+        for entry in self._list(manager, filters, **kwargs):
+            if match(entry):
+                return entry
+        else:
+            return None
+
+    def _snapshot(self, key, manager, keys, filters=None, **kwargs):
+        """Return a snapshot of a collection, listing it once per run.
+
+        Repeated lookups in the same collection are answered from the
+        snapshot index. Commands that create, update or delete entries keep
+        the snapshot up to date, see ``_remember``.
+
+        :param key: ``tuple``  Name of the snapshot, eg ('endpoints', region)
+        :param manager: keystoneclient manager, eg self.keystone.endpoints
+        :param keys: ``callable``  Return the list of index keys of an entry.
+        :param filters: ``dict``  Query parameters used to narrow the list.
+        :param kwargs: Arguments always passed to the list call.
+        """
+        with self._key_lock(key):
+            snapshot = self.snapshots.get(key)
+            if snapshot is None:
+                snapshot = Snapshot(
+                    keys, self._list(manager, filters or {}, **kwargs)
+                )
+                with self.lock:
+                    self.snapshots[key] = snapshot
+            return snapshot
+
+    def _key_lock(self, key):
+        """Return the lock serialising the first listing of a key.
+
+        Listings of different keys run concurrently, the shared lock is only
+        held to publish their results.
+
+        :param key: ``tuple``  Name of the snapshot or cache entry.
+        """
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _remember(self, key, entry, old=None):
+        """Record a created or updated entry in a snapshot, if one is taken.
+
+        :param key: ``tuple``  Name of the snapshot.
+        :param entry: The entry returned by the create or update call.
+        :param old: The entry that was updated, if any.
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot is None:
+                return
+            if old is not None:
+                snapshot.replace(old, entry)
+            else:
+                snapshot.add(entry)
+
+    def _forget(self, key, entry):
+        """Remove a deleted entry from a snapshot, if one is taken.
+
+        :param key: ``tuple``  Name of the snapshot.
+        :param entry: The entry that was deleted.
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot is not None:
+                snapshot.remove(entry)
+
     def _get_domain_from_vars(self, variables):
         # NOTE(sigmavirus24): Since we don't require domain, this will be None
         # in the dictionary. When we pop it, we can't provide a default
@@ -634,11 +1267,11 @@ class ManageKeystone(object):
 
         :param str name: Name of the domain.
         """
-        for entry in self.keystone.domains.list():
-            if entry.name == name:
-                return entry
-        else:
-            return None
+        return self._snapshot(
+            ('domains',),
+            self.keystone.domains,
+            lambda entry: [entry.name]
+        ).get(name)
 
     def _get_project(self, name):
         """Return project information.
@@ -647,11 +1280,11 @@ class ManageKeystone(object):
 
         :param name: ``str``  Name of the project.
         """
-        for entry in self.keystone.projects.list():
-            if entry.name == name:
-                return entry
-        else:
-            return None
+        return self._cached(('project', name), lambda: self._find(
+            self.keystone.projects,
+            lambda entry: entry.name == name,
+            filters={'name': name}
+        ))
 
     def get_tenant(self, variables):
         return self.get_project(variables)
@@ -701,12 +1334,19 @@ class ManageKeystone(object):
         project = self._get_project(name=project_name)
         if project is None:
             self.state_change = True
-            project = self.keystone.projects.create(
-                name=project_name,
-                description=project_description,
-                domain=domain,
-                enabled=True
-            )
+            if self.module.check_mode:
+                self._plan('create', 'project', project_name,
+                           domain=getattr(domain, 'name', None))
+                project = Planned('project', name=project_name,
+                                  domain_id=getattr(domain, 'id', None))
+            else:
+                project = self.keystone.projects.create(
+                    name=project_name,
+                    description=project_description,
+                    domain=domain,
+                    enabled=True
+                )
+            self.cache[('project', project_name)] = project
 
         return self._facts(facts={'id': project.id})
 
@@ -717,11 +1357,13 @@ class ManageKeystone(object):
 
         :param name: ``str``  Name of the user.
         """
-        for entry in self.keystone.users.list(domain=domain):
-            if getattr(entry, 'name', None) == name:
-                return entry
-        else:
-            return None
+        key = ('user', name, getattr(domain, 'id', None))
+        return self._cached(key, lambda: self._find(
+            self.keystone.users,
+            lambda entry: getattr(entry, 'name', None) == name,
+            filters={'name': name},
+            domain=domain
+        ))
 
     def get_user(self, variables):
         """Return a project id.
@@ -774,13 +1416,23 @@ class ManageKeystone(object):
         user = self._get_user(name=user_name, domain=domain)
         if user is None:
             self.state_change = True
-            user = self.keystone.users.create(
-                name=user_name,
-                password=password,
-                email=email,
-                domain=domain,
-                default_project=project
-            )
+            if self.module.check_mode:
+                self._plan('create', 'user', user_name,
+                           domain=getattr(domain, 'name', None),
+                           project=project_name)
+                user = Planned('user', name=user_name,
+                               domain_id=getattr(domain, 'id', None))
+            else:
+                user = self.keystone.users.create(
+                    name=user_name,
+                    password=password,
+                    email=email,
+                    domain=domain,
+                    default_project=project
+                )
+            self.cache[('user', user_name, getattr(domain, 'id', None))] = user
+            # Role assignments on a project look the user up in all domains
+            self.cache.setdefault(('user', user_name, None), user)
 
         return self._facts(facts={'id': user.id})
 
@@ -792,11 +1444,14 @@ class ManageKeystone(object):
         :param name: ``str``  Name of the role.
         :param domain: ``str`` ID of the domain
         """
-        for entry in self.keystone.roles.list(domain=domain):
-            if entry.name == name:
-                return entry
-        else:
-            return None
+        # NOTE: keystoneclient only uses the domain to list the grants of a
+        # user or group, a plain listing always returns every role. A single
+        # snapshot therefore serves every domain.
+        return self._snapshot(
+            ('roles',),
+            self.keystone.roles,
+            lambda entry: [entry.name]
+        ).get(name)
 
     def _get_group(self, name, domain='Default'):
         """Return a group by name.
@@ -805,15 +1460,18 @@ class ManageKeystone(object):
 
         :param name: ``str``  Name of the role.
         """
-        for entry in self.keystone.groups.list(domain=domain):
+        def match(entry):
             if domain is None:
-                if entry.name == name:
-                    return entry
-            else:
-                if entry.name == name and entry.domain_id == domain.id:
-                    return entry
-        else:
-            return None
+                return entry.name == name
+            return entry.name == name and entry.domain_id == domain.id
+
+        key = ('group', name, getattr(domain, 'id', None))
+        return self._cached(key, lambda: self._find(
+            self.keystone.groups,
+            match,
+            filters={'name': name},
+            domain=domain
+        ))
 
     def get_role(self, variables):
         """Return a role by name.
@@ -895,33 +1553,114 @@ class ManageKeystone(object):
         role = self._get_role(name=role_name, domain=domain)
         if role is None:
             self.state_change = True
-            role = self.keystone.roles.create(role_name)
+            if self.module.check_mode:
+                self._plan('create', 'role', role_name)
+                role = Planned('role', name=role_name)
+            else:
+                role = self.keystone.roles.create(role_name)
+            self._remember(('roles',), role)
 
         return self._facts(facts={'id': role.id})
 
-    def _get_user_roles(self, name, user, project, domain):
-        role_list = self.keystone.roles.list(
-            user=user,
-            project=project,
-            domain=domain
-        )
-        for entry in role_list:
-            if entry.name == name:
-                return entry
-        else:
-            return None
+    def _has_role(self, role, project, domain, user=None, group=None):
+        """Return whether a role is assigned to a user or group.
 
-    def _get_group_roles(self, name, group, project, domain):
-        group_list = self.keystone.roles.list(
-            group=group,
-            project=project,
-            domain=domain
-        )
-        for entry in group_list:
-            if entry.name == name:
-                return entry
+        A single command asks Keystone for exactly that role assignment. A
+        batch lists every assignment of the role on the project or domain
+        once and checks all its users and groups against that listing.
+
+        :param role: The role to look for.
+        :param project: The project the role is assigned on, or None.
+        :param domain: The domain the role is assigned on, or None.
+        :param user: The user the role is assigned to.
+        :param group: The group the role is assigned to.
+        """
+        if self.module.params.get('batch') is None:
+            if any(isinstance(entry, Planned)
+                   for entry in (role, project, domain, user, group)):
+                return False
+            return any(
+                self._direct(entry)
+                for entry in self.keystone.role_assignments.list(
+                    user=user, group=group, role=role,
+                    project=project, domain=domain
+                )
+            )
+
+        actors = self._role_actors(role, project, domain)
+        with self.lock:
+            return self._actor(user, group) in actors
+
+    def _role_actors(self, role, project, domain):
+        """Return the users and groups holding a role on a target.
+
+        :param role: The role to look for.
+        :param project: The project the role is assigned on, or None.
+        :param domain: The domain the role is assigned on, or None.
+        """
+        key = ('role_assignments', role.id, getattr(project, 'id', None),
+               getattr(domain, 'id', None))
+        with self._key_lock(key):
+            actors = self.cache.get(key)
+            if actors is None:
+                actors = set()
+                if any(isinstance(entry, Planned)
+                       for entry in (role, project, domain)):
+                    entries = []
+                else:
+                    entries = self.keystone.role_assignments.list(
+                        role=role, project=project, domain=domain
+                    )
+                for entry in entries:
+                    if not self._direct(entry):
+                        continue
+                    assignment = entry.to_dict()
+                    for kind in ('user', 'group'):
+                        if kind in assignment:
+                            actors.add((kind, assignment[kind]['id']))
+                with self.lock:
+                    self.cache[key] = actors
+            return actors
+
+    @staticmethod
+    def _direct(assignment):
+        """Return whether a role assignment applies to its target itself.
+
+        Assignments inherited to the projects of the target are listed along
+        with the direct ones, but do not grant the role on the target.
+        """
+        scope = assignment.to_dict().get('scope', {})
+        return 'OS-INHERIT:inherited_to' not in scope
+
+    @staticmethod
+    def _actor(user, group):
+        if user is not None:
+            return ('user', user.id)
+        return ('group', group.id)
+
+    def _grant(self, role, project, domain, user=None, group=None):
+        """Assign a role to a user or group on a project or domain."""
+        self.state_change = True
+        if self.module.check_mode:
+            details = {}
+            if user is not None:
+                details['user'] = user.name
+            else:
+                details['group'] = group.name
+            if project is not None:
+                details['project'] = project.name
+            else:
+                details['domain'] = domain.name
+            self._plan('create', 'role_assignment', role.name, **details)
         else:
-            return None
+            self.keystone.roles.grant(
+                user=user, group=group, role=role, project=project,
+                domain=domain
+            )
+        if self.module.params.get('batch') is not None:
+            actors = self._role_actors(role, project, domain)
+            with self.lock:
+                actors.add(self._actor(user, group))
 
     def ensure_user_role(self, variables):
         self._authenticate()
@@ -944,20 +1683,11 @@ class ManageKeystone(object):
             role_name=role_name, group_name=None, domain=domain
         )
 
-        user_role = self._get_user_roles(
-            name=role_name, user=user, project=project, domain=domain
-        )
+        if not self._has_role(role=role, project=project, domain=domain,
+                              user=user):
+            self._grant(role=role, project=project, domain=domain, user=user)
 
-        if user_role is None:
-            self.state_change = True
-            self.keystone.roles.grant(
-                user=user, role=role, project=project, domain=domain
-            )
-            user_role = self._get_user_roles(
-                name=role_name, user=user, project=project, domain=domain
-            )
-
-        return self._facts(facts={'id': user_role.id})
+        return self._facts(facts={'id': role.id})
 
     def ensure_group_role(self, variables):
         self._authenticate()
@@ -976,23 +1706,12 @@ class ManageKeystone(object):
             role_name=role_name, user_name=None, domain=domain
         )
 
-        group_role = self._get_group_roles(
-            name=role_name, group=group, project=project, domain=domain
-        )
-
-        if group_role is None:
-            self.state_change = True
-            self.keystone.roles.grant(
-                group=group, role=role, project=project, domain=domain
-            )
-            group_role = self._get_group_roles(
-                name=role_name,
-                group=group,
-                project=project,
-                domain=domain
-            )
+        if not self._has_role(role=role, project=project, domain=domain,
+                              group=group):
+            self._grant(role=role, project=project, domain=domain,
+                        group=group)
 
-        return self._facts(facts={'id': group_role.id})
+        return self._facts(facts={'id': role.id})
 
     def ensure_group(self, variables):
         """Create a new group within Keystone if it does not exist.
@@ -1016,21 +1735,28 @@ class ManageKeystone(object):
 
         if group is None:
             self.state_change = True
-            group = self.keystone.groups.create(
-                name=group_name, domain=domain
-            )
+            if self.module.check_mode:
+                self._plan('create', 'group', group_name,
+                           domain=getattr(domain, 'name', None))
+                group = Planned('group', name=group_name,
+                                domain_id=getattr(domain, 'id', None))
+            else:
+                group = self.keystone.groups.create(
+                    name=group_name, domain=domain
+                )
+            key = ('group', group_name, getattr(domain, 'id', None))
+            self.cache[key] = group
+            # Role assignments on a project look the group up in all domains
+            self.cache.setdefault(('group', group_name, None), group)
 
         return self._facts(facts={'id': group.id})
 
     def _get_service(self, name, srv_type=None):
-        for entry in self.keystone.services.list():
-            if srv_type is not None:
-                if entry.type == srv_type and name == entry.name:
-                    return entry
-            elif entry.name == name:
-                return entry
-        else:
-            return None
+        return self._snapshot(
+            ('services',),
+            self.keystone.services,
+            lambda entry: [(entry.name, entry.type), (entry.name, None)]
+        ).get((name, srv_type))
 
     def ensure_service(self, variables):
         """Create a new service within Keystone if it does not exist.
@@ -1051,11 +1777,18 @@ class ManageKeystone(object):
         service = self._get_service(name=service_name, srv_type=service_type)
         if service is None or service.type != service_type:
             self.state_change = True
-            service = self.keystone.services.create(
-                name=service_name,
-                type=service_type,
-                description=description
-            )
+            if self.module.check_mode:
+                self._plan('create', 'service', service_name,
+                           type=service_type)
+                service = Planned('service', name=service_name,
+                                  type=service_type)
+            else:
+                service = self.keystone.services.create(
+                    name=service_name,
+                    type=service_type,
+                    description=description
+                )
+            self._remember(('services',), service)
 
         return self._facts(facts={'id': service.id})
 
@@ -1071,16 +1804,9 @@ class ManageKeystone(object):
         :param region: geographic location of the endpoint
 
         """
-        for entry in self.keystone.endpoints.list():
-            check = [
-                entry.region == region,
-                entry.service_id == service_id,
-                entry.interface == interface
-            ]
-            if all(check):
-                return entry
-        else:
-            return None
+        return self._endpoints(region).get(
+            ('details', region, service_id, interface)
+        )
 
     def _get_endpoint(self, region, url, interface):
         """ Getting endpoints per URL
@@ -1088,16 +1814,25 @@ class ManageKeystone(object):
         URL, region and interface.
         This interface should be deprecated in next release.
         """
-        for entry in self.keystone.endpoints.list():
-            check = [
-                entry.region == region,
-                entry.url == url,
-                entry.interface == interface
-            ]
-            if all(check):
-                return entry
-        else:
-            return None
+        return self._endpoints(region).get(('url', region, url, interface))
+
+    def _endpoints(self, region):
+        """Return the snapshot of the endpoints of a region.
+
+        Every endpoint is indexed by its region, service id and interface,
+        and by its region, url and interface.
+
+        :param region: geographic location of the endpoints
+        """
+        return self._snapshot(
+            ('endpoints', region),
+            self.keystone.endpoints,
+            lambda entry: [
+                ('details', entry.region, entry.service_id, entry.interface),
+                ('url', entry.region, entry.url, entry.interface)
+            ],
+            filters={'region_id': region}
+        )
 
     def ensure_endpoint(self, variables):
         """Ensures the deletion/modification/addition of endpoints
@@ -1133,8 +1868,8 @@ class ManageKeystone(object):
 
         endpoints = {}
         for endpoint_dict in endpoint_list:
-            url = endpoint_dict.pop('url')
-            interface = endpoint_dict.pop('interface')
+            url = endpoint_dict['url']
+            interface = endpoint_dict['interface']
             endpoint = self._get_endpoint(
                 region=region,
                 url=url,
@@ -1154,18 +1889,12 @@ class ManageKeystone(object):
                 )
                 if similar_endpoint is not None:
                     if similar_endpoint.url != url:
-                        self.state_change = True
-                        endpoint = self.keystone.endpoints.update(
-                            endpoint=similar_endpoint,
-                            url=url
+                        endpoint = self._update_endpoint(
+                            region, service, similar_endpoint, url
                         )
                 elif endpoint is None:
-                    self.state_change = True
-                    endpoint = self.keystone.endpoints.create(
-                        region=region,
-                        service=service,
-                        url=url,
-                        interface=interface
+                    endpoint = self._create_endpoint(
+                        region, service, url, interface
                     )
             # The update state is deprecated and should be removed in Q
             elif state == 'update':
@@ -1181,25 +1910,25 @@ class ManageKeystone(object):
                     interface=interface
                 )
                 if similar_endpoint is None:
-                    self.state_change = True
-                    endpoint = self.keystone.endpoints.create(
-                        region=region,
-                        service=service,
-                        url=url,
-                        interface=interface
+                    endpoint = self._create_endpoint(
+                        region, service, url, interface
                     )
                 elif similar_endpoint.url != url:
-                    self.state_change = True
-                    endpoint = self.keystone.endpoints.update(
-                        endpoint=similar_endpoint,
-                        url=url
+                    endpoint = self._update_endpoint(
+                        region, service, similar_endpoint, url
                     )
             elif state == 'absent':
                 if endpoint is not None:
                     self.state_change = True
-                    result = self.keystone.endpoints.delete(endpoint.id)
-                    if result[0].status_code != 204:
-                        module.fail()
+                    if self.module.check_mode:
+                        self._plan('delete', 'endpoint', service.name,
+                                   region=region, interface=interface,
+                                   url=url)
+                    else:
+                        result = self.keystone.endpoints.delete(endpoint.id)
+                        if result[0].status_code != 204:
+                            module.fail()
+                    self._forget(('endpoints', region), endpoint)
 
         if state != 'absent':
             endpoints[interface] = endpoint
@@ -1208,6 +1937,61 @@ class ManageKeystone(object):
         else:
             return self._facts({})
 
+    def _create_endpoint(self, region, service, url, interface):
+        """Create an endpoint, or plan its creation in check mode."""
+        self.state_change = True
+        if self.module.check_mode:
+            self._plan('create', 'endpoint', service.name, region=region,
+                       interface=interface, url=url)
+            endpoint = Planned('endpoint',
+                               name='%s-%s-%s' % (region, service.name,
+                                                  interface),
+                               region=region, service_id=service.id,
+                               interface=interface, url=url)
+        else:
+            endpoint = self.keystone.endpoints.create(
+                region=region,
+                service=service,
+                url=url,
+                interface=interface
+            )
+        self._remember(('endpoints', region), endpoint)
+        return endpoint
+
+    def _update_endpoint(self, region, service, endpoint, url):
+        """Change the url of an endpoint, or plan it in check mode."""
+        self.state_change = True
+        if self.module.check_mode:
+            self._plan('update', 'endpoint', service.name, region=region,
+                       interface=endpoint.interface, url=url,
+                       previous_url=endpoint.url)
+            updated = Planned('endpoint', id=endpoint.id, region=region,
+                              service_id=endpoint.service_id,
+                              interface=endpoint.interface, url=url)
+        else:
+            updated = self.keystone.endpoints.update(
+                endpoint=endpoint,
+                url=url
+            )
+        self._remember(('endpoints', region), updated, old=endpoint)
+        return updated
+
+    def _generic_exists(self, manager, args_dict):
+        """Return whether the resource _ensure_generic manages exists."""
+        if manager.collection_key == 'domains':
+            return self._get_domain(args_dict['name']) is not None
+        try:
+            if manager.collection_key == 'protocols':
+                manager.get(args_dict['identity_provider'],
+                            args_dict['protocol_id'])
+            elif manager.collection_key == 'mappings':
+                manager.get(args_dict['mapping_id'])
+            else:
+                manager.get(args_dict['id'])
+        except kexceptions.NotFound:
+            return False
+        return True
+
     def _ensure_generic(self, manager, required_vars, variables):
         """Try and create a new 'thing' in keystone.
 
@@ -1233,11 +2017,24 @@ class ManageKeystone(object):
         # Translate ansible module argument names to manager expected names
         args_dict = {required_vars[k]: v for k, v in variables_dict.items()}
 
-        try:
-            manager.create(**args_dict)
-            self.state_change = True
-        except kexceptions.Conflict:
-            self.state_change = False
+        if self.module.check_mode:
+            if not self._generic_exists(manager, args_dict):
+                name = (args_dict.get('name') or args_dict.get('id') or
+                        args_dict.get('mapping_id') or
+                        args_dict.get('protocol_id'))
+                self._plan('create', manager.collection_key[:-1], name)
+                if manager.collection_key == 'domains':
+                    self._remember(('domains',), Planned('domain', name=name))
+        else:
+            try:
+                manager.create(**args_dict)
+                self.state_change = True
+                # Entries created here are not indexed, list them again if
+                # needed
+                with self.lock:
+                    self.snapshots.pop((manager.collection_key,), None)
+            except kexceptions.Conflict:
+                self.state_change = False
 
         try:
             return self._facts(facts={
@@ -1255,7 +2052,7 @@ class ManageKeystone(object):
                          'idp_remote_ids': 'remote_ids',
                          'idp_enabled': 'enabled'}
 
-        if self.module.params.get('idp_domain_id') is not None:
+        if self.params.get('idp_domain_id') is not None:
             required_vars['idp_domain_id'] = 'domain_id'
         else:
             variables.remove('idp_domain_id')
@@ -1385,14 +2182,32 @@ def main():
                 type='list'
             ),
             command=dict(
-                required=True,
+                required=False,
                 choices=COMMAND_MAP.keys()
             ),
+            batch=dict(
+                type='list',
+                required=False
+            ),
+            batch_workers=dict(
+                type='int',
+                required=False,
+                default=4
+            ),
             insecure=dict(
                 default=False,
                 required=False,
                 type='bool'
             ),
+            token_cache=dict(
+                type='path',
+                required=False
+            ),
+            token_cache_margin=dict(
+                type='int',
+                required=False,
+                default=300
+            ),
             return_code=dict(
                 type='str',
                 default='0'
@@ -1458,14 +2273,24 @@ def main():
                 default='present'
             )
         ),
-        supports_check_mode=False,
+        supports_check_mode=True,
         mutually_exclusive=[
             ['token', 'login_user'],
             ['token', 'login_password'],
-            ['token', 'login_tenant_name']
+            ['token', 'login_tenant_name'],
+            ['command', 'batch']
+        ],
+        required_one_of=[
+            ['command', 'batch']
         ]
     )
 
+    # The argument spec does not reach into batch items, mask the password
+    # of every item the same way as the password of the task.
+    for item in module.params.get('batch') or []:
+        if isinstance(item, dict) and item.get('password'):
+            module.no_log_values.add(str(item['password']))
+
     km = ManageKeystone(module=module)
     if not keystoneclient_found:
         km.failure(
@@ -0,0 +1,63 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is implemented by the put_files action plugin.
+
+DOCUMENTATION = """
+---
+module: put_files
+short_description:
+    - Copy many files into a container with a single command
+description:
+    - Packs files from the deployment host into one tar archive which is
+      extracted by tar running as root inside the container, so owners and
+      modes are set without a command per file.
+    - Needs a container target reached with the openstack.osa.ssh
+      connection plugin.
+    - Files are always transferred, the task always reports a change.
+options:
+    files:
+        description:
+            - List of files to copy. Every item is a dict with a C(src) path
+              on the deployment host, looked up like the src of
+              M(ansible.builtin.copy), an absolute C(dest) path inside the
+              container, and optionally an C(owner) as C(user) or
+              C(user:group), defaulting to C(container_user), and a C(mode)
+              as an octal string, defaulting to the mode of C(src).
+            - Missing parent directories are created owned by root.
+        required: true
+        type: list
+        elements: dict
+author: OpenStack-Ansible contributors
+"""
+
+EXAMPLES = """
+- name: Install the service configuration files
+  openstack.osa.put_files:
+    files:
+      - src: api-paste.ini
+        dest: /etc/nova/api-paste.ini
+        owner: nova:nova
+        mode: "0640"
+      - src: rootwrap.d/compute.filters
+        dest: /etc/nova/rootwrap.d/compute.filters
+        owner: root
+        mode: "0644"
+"""
+
+RETURN = """
+dest:
+    description: Destination paths of the copied files.
+    returned: success
+    type: list
+    elements: str
+"""
@@ -0,0 +1,188 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import uuid
+from unittest import mock
+
+import pytest
+
+from ansible.module_utils.testing import patch_module_args
+
+from ansible_collections.openstack.osa.plugins.modules import keystone
+
+
+class Resource(object):
+    """A keystone resource as returned by keystoneclient managers."""
+
+    def __init__(self, **attributes):
+        self.id = uuid.uuid4().hex
+        self.__dict__.update(attributes)
+
+
+class Manager(object):
+    """A keystoneclient manager keeping its entries in memory."""
+
+    def __init__(self, *entries):
+        self.entries = list(entries)
+        self.created = []
+        self.error = None
+
+    def list(self, **query):
+        name = query.get('name')
+        return [entry for entry in self.entries
+                if name is None or entry.name == name]
+
+    def create(self, **attributes):
+        if self.error is not None:
+            raise self.error
+        entry = Resource(**attributes)
+        self.created.append(entry)
+        self.entries.append(entry)
+        return entry
+
+
+@pytest.fixture
+def cloud():
+    """Return the fake keystone client handed out to the module."""
+    client = mock.MagicMock()
+    client.domains = Manager(Resource(name='Default'))
+    client.projects = Manager(Resource(name='service'))
+    client.users = Manager()
+    with mock.patch.object(keystone.client, 'Client', return_value=client):
+        yield client
+
+
+@pytest.fixture
+def run_module(cloud, capsys):
+    """Run the module with the given arguments and return its result."""
+    def run(check_mode=False, **args):
+        args.setdefault('endpoint', 'http://keystone.example.com:5000/v3')
+        args.setdefault('token', 'admin-token')
+        args['_ansible_check_mode'] = check_mode
+        with patch_module_args(args):
+            with pytest.raises(SystemExit):
+                keystone.main()
+        return json.loads(capsys.readouterr().out)
+    return run
+
+
+def stages(items, workers=4):
+    """Return the batch stages as lists of item indexes."""
+    module = mock.MagicMock(params={'batch': items})
+    manager = keystone.ManageKeystone(module=module)
+    return [[[index for index, _ in group] for group in stage]
+            for stage in manager._batch_stages(items, workers)]
+
+
+def test_batch_stages_order():
+    items = [
+        {'command': 'ensure_user', 'user_name': 'nova'},
+        {'command': 'get_project', 'project_name': 'service'},
+        {'command': 'ensure_project', 'project_name': 'service'},
+        {'command': 'ensure_domain', 'domain_name': 'heat'},
+        {'command': 'ensure_user_role', 'user_name': 'nova',
+         'project_name': 'service', 'role_name': 'admin'},
+    ]
+    assert stages(items) == [[[3]], [[2]], [[0]], [[4]], [[1]]]
+
+
+def test_batch_stages_keys():
+    items = [
+        {'command': 'ensure_user', 'user_name': 'nova'},
+        {'command': 'ensure_user', 'user_name': 'glance'},
+        {'command': 'ensure_user', 'user_name': 'nova',
+         'domain_name': 'Default'},
+        {'command': 'ensure_user', 'user_name': 'nova',
+         'domain_name': 'heat'},
+        {'command': 'get_user', 'user_name': 'nova'},
+        {'command': 'get_user', 'user_name': 'nova'},
+    ]
+    assert stages(items) == [[[0, 2], [1], [3]], [[4], [5]]]
+
+
+def test_batch_stages_single_worker():
+    items = [
+        {'command': 'get_project', 'project_name': 'service'},
+        {'command': 'ensure_project', 'project_name': 'service'},
+    ]
+    assert stages(items, workers=1) == [[[0, 1]]]
+
+
+def test_batch_item_failure(run_module, cloud):
+    result = run_module(batch=[
+        {'command': 'ensure_project', 'project_name': 'admin'},
+        {'command': 'get_project', 'project_name': 'missing'},
+    ])
+
+    assert result['failed']
+    assert result['failed_item'] == 1
+    assert result['msg'] == 'project was not found, does it exist?'
+    assert result['changed']
+    assert [r['item'] for r in result['results']] == [0]
+    assert [p.name for p in cloud.projects.created] == ['admin']
+
+
+def test_batch_item_exception(run_module, cloud):
+    cloud.users.error = RuntimeError('connection reset')
+    result = run_module(batch=[
+        {'command': 'ensure_project', 'project_name': 'service'},
+        {'command': 'ensure_user', 'user_name': 'nova', 'password': 'secret'},
+    ])
+
+    assert result['failed']
+    assert result['failed_item'] == 1
+    assert 'RuntimeError: connection reset' in result['msg']
+    assert [r['item'] for r in result['results']] == [0]
+
+
+def test_batch_item_password_masked(run_module, cloud):
+    cloud.users.error = RuntimeError('rejected password s3cr3t-pa55')
+    result = run_module(batch=[
+        {'command': 'ensure_user', 'user_name': 'nova',
+         'password': 's3cr3t-pa55'},
+    ])
+
+    assert result['failed']
+    assert 's3cr3t-pa55' not in json.dumps(result)
+
+
+def test_check_mode_plan(run_module, cloud):
+    result = run_module(check_mode=True, batch=[
+        {'command': 'ensure_user', 'user_name': 'nova', 'password': 'secret',
+         'project_name': 'admin'},
+        {'command': 'ensure_project', 'project_name': 'admin'},
+        {'command': 'ensure_user', 'user_name': 'glance',
+         'password': 'secret', 'project_name': 'service'},
+    ])
+
+    assert result['changed']
+    assert [(c['action'], c['resource'], c['name'])
+            for c in result['plan']] == [
+        ('create', 'user', 'nova'),
+        ('create', 'project', 'admin'),
+        ('create', 'user', 'glance'),
+    ]
+    assert [r['changed'] for r in result['results']] == [True, True, True]
+    assert result['results'][1]['keystone_facts'] == {
+        'id': 'planned-project-admin'
+    }
+    assert cloud.projects.created == []
+    assert cloud.users.created == []
+
+
+def test_check_mode_noop(run_module, cloud):
+    result = run_module(check_mode=True, command='ensure_project',
+                        project_name='service')
+
+    assert not result['changed']
+    assert result['plan'] == []